@@ -61,8 +61,8 @@ class Generator(nn.Module):
                G_lr=5e-5, G_B1=0.0, G_B2=0.999, adam_eps=1e-8,
                BN_eps=1e-5, SN_eps=1e-12, G_mixed_precision=False, G_fp16=False,
                G_init='ortho', skip_init=False, no_optim=False,
-               G_param='SN', norm_style='bn',
-               **kwargs):
+               G_param='SN', norm_style='bn', channels_last=False,
+               G_subpixel=False, G_checkpoint='0', **kwargs):
     super(Generator, self).__init__()
     # Channel width mulitplier
     self.ch = G_ch
@@ -102,8 +102,13 @@ class Generator(nn.Module):
     self.SN_eps = SN_eps
     # fp16?
     self.fp16 = G_fp16
+    # Use channels_last memory format?
+    self.channels_last = channels_last
     # Architecture dict
     self.arch = G_arch(self.ch, self.attention)[resolution]
+    # Which blocks (by output resolution) to run under activation checkpointing
+    self.checkpoint_blocks = [res in [int(item) for item in G_checkpoint.split('_')]
+                              for res in self.arch['resolution']]
 
     # If using hierarchical latents, adjust z
     if self.hier:
@@ -162,7 +167,8 @@ class Generator(nn.Module):
                              which_conv=self.which_conv,
                              which_bn=self.which_bn,
                              activation=self.activation,
-                             upsample=(functools.partial(F.interpolate, scale_factor=2)
+                             subpixel=G_subpixel,
+                             upsample=(nn.Upsample(scale_factor=2)
                                        if self.arch['upsample'][index] else None))]]
 
       # If attention on this block, attach it to the end
@@ -185,6 +191,11 @@ class Generator(nn.Module):
     if not skip_init:
       self.init_weights()
 
+    # Convert conv weights to channels_last if requested; the convs will then
+    # also produce channels_last outputs.
+    if self.channels_last:
+      self.to(memory_format=torch.channels_last)
+
     # Set up optimizer
     # If this is an EMA copy, no need for an optim, so just return now
     if no_optim:
@@ -193,7 +204,9 @@ class Generator(nn.Module):
     if G_mixed_precision:
       print('Using fp16 adam in G...')
       import utils
-      self.optim = utils.Adam16(params=self.parameters(), lr=self.lr,
+      # FlatAdam16 only pays off on GPU, where kernel launches dominate
+      adam16 = utils.FlatAdam16 if torch.cuda.is_available() else utils.Adam16
+      self.optim = adam16(params=self.parameters(), lr=self.lr,
                            betas=(self.B1, self.B2), weight_decay=0,
                            eps=self.adam_eps)
     else:
@@ -223,6 +236,32 @@ class Generator(nn.Module):
         self.param_count += sum([p.data.nelement() for p in module.parameters()])
     print('Param count for G''s initialized parameters: %d' % self.param_count)
 
+  # Convert this Generator into an inference-only one, with its eval-mode BN
+  # statistics and spectral norms folded into plain weights, and activations
+  # fused into the class-conditional affines. The result matches the eval-mode
+  # output of the original G, and cannot be trained further.
+  def fold(self):
+    self.eval()
+    with torch.no_grad():
+      self.linear = layers.fold_linear(self.linear)
+      for blocklist in self.blocks:
+        for block in blocklist:
+          block.fold()
+      self.output_layer = nn.Sequential(
+        layers.fold_bn(self.output_layer[0], self.activation),
+        layers.fold_conv(self.output_layer[2]))
+    return self
+
+  # Run the index-th set of blocks under activation checkpointing
+  @torch.jit.unused
+  def checkpointed(self, index, h, y):
+    # type: (int, Tensor, Tensor) -> Tensor
+    def run(h, y):
+      for block in self.blocks[index]:
+        h = block(h, y)
+      return h
+    return layers.checkpoint(run, h, y)
+
   # Note on this forward function: we pass in a y vector which has
   # already been passed through G.shared to enable easy class-wise
   # interpolation later. If we passed in the one-hot and then ran it through
@@ -240,12 +279,18 @@ class Generator(nn.Module):
     h = self.linear(z)
     # Reshape
     h = h.view(h.size(0), -1, self.bottom_width, self.bottom_width)
+    if self.channels_last:
+      h = h.contiguous(memory_format=torch.channels_last)
     
     # Loop over blocks
     for index, blocklist in enumerate(self.blocks):
-      # Second inner loop in case block has multiple layers
-      for block in blocklist:
-        h = block(h, ys[index])
+      # Recompute this block's activations in backward instead of storing them?
+      if self.checkpoint_blocks[index] and self.training and torch.is_grad_enabled():
+        h = self.checkpointed(index, h, ys[index])
+      else:
+        # Second inner loop in case block has multiple layers
+        for block in blocklist:
+          h = block(h, ys[index])
         
     # Apply batchnorm-relu-conv-tanh at output
     return torch.tanh(self.output_layer(h))
@@ -287,7 +332,9 @@ class Discriminator(nn.Module):
                num_D_SVs=1, num_D_SV_itrs=1, D_activation=nn.ReLU(inplace=False),
                D_lr=2e-4, D_B1=0.0, D_B2=0.999, adam_eps=1e-8,
                SN_eps=1e-12, output_dim=1, D_mixed_precision=False, D_fp16=False,
-               D_init='ortho', skip_init=False, D_param='SN', **kwargs):
+               D_init='ortho', skip_init=False, D_param='SN',
+               channels_last=False, D_fused_pool=False,
+               D_checkpoint='0', **kwargs):
     super(Discriminator, self).__init__()
     # Width multiplier
     self.ch = D_ch
@@ -311,8 +358,13 @@ class Discriminator(nn.Module):
     self.SN_eps = SN_eps
     # Fp16?
     self.fp16 = D_fp16
+    # Use channels_last memory format?
+    self.channels_last = channels_last
     # Architecture
     self.arch = D_arch(self.ch, self.attention)[resolution]
+    # Which blocks (by output resolution) to run under activation checkpointing
+    self.checkpoint_blocks = [res in [int(item) for item in D_checkpoint.split('_')]
+                              for res in self.arch['resolution']]
 
     # Which convs, batchnorms, and linear layers to use
     # No option to turn off SN in D right now
@@ -338,7 +390,8 @@ class Discriminator(nn.Module):
                        wide=self.D_wide,
                        activation=self.activation,
                        preactivation=(index > 0),
-                       downsample=(nn.AvgPool2d(2) if self.arch['downsample'][index] else None))]]
+                       downsample=(nn.AvgPool2d(2) if self.arch['downsample'][index] else None),
+                       fused_pool=D_fused_pool)]]
       # If attention on this block, attach it to the end
       if self.arch['attention'][self.arch['resolution'][index]]:
         print('Adding attention layer in D at resolution %d' % self.arch['resolution'][index])
@@ -356,12 +409,18 @@ class Discriminator(nn.Module):
     if not skip_init:
       self.init_weights()
 
+    # Convert conv weights to channels_last if requested; the convs will then
+    # also produce channels_last outputs.
+    if self.channels_last:
+      self.to(memory_format=torch.channels_last)
+
     # Set up optimizer
     self.lr, self.B1, self.B2, self.adam_eps = D_lr, D_B1, D_B2, adam_eps
     if D_mixed_precision:
       print('Using fp16 adam in D...')
       import utils
-      self.optim = utils.Adam16(params=self.parameters(), lr=self.lr,
+      adam16 = utils.FlatAdam16 if torch.cuda.is_available() else utils.Adam16
+      self.optim = adam16(params=self.parameters(), lr=self.lr,
                              betas=(self.B1, self.B2), weight_decay=0, eps=self.adam_eps)
     else:
       self.optim = optim.Adam(params=self.parameters(), lr=self.lr,
@@ -388,13 +447,25 @@ class Discriminator(nn.Module):
         self.param_count += sum([p.data.nelement() for p in module.parameters()])
     print('Param count for D''s initialized parameters: %d' % self.param_count)
 
+  # Run the index-th set of blocks under activation checkpointing
+  def checkpointed(self, index, h):
+    def run(h):
+      for block in self.blocks[index]:
+        h = block(h)
+      return h
+    return layers.checkpoint(run, h)
+
   def forward(self, x, y=None):
     # Stick x into h for cleaner for loops without flow control
     h = x
     # Loop over blocks
     for index, blocklist in enumerate(self.blocks):
-      for block in blocklist:
-        h = block(h)
+      # Recompute this block's activations in backward instead of storing them?
+      if self.checkpoint_blocks[index] and self.training and torch.is_grad_enabled():
+        h = self.checkpointed(index, h)
+      else:
+        for block in blocklist:
+          h = block(h)
     # Apply global sum pooling as in SN-GAN
     h = torch.sum(self.activation(h), [2, 3])
     # Get initial class-unconditional output
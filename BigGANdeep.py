@@ -21,9 +21,11 @@ from sync_batchnorm import SynchronizedBatchNorm2d as SyncBatchNorm2d
 
 # Channel ratio is the ratio of 
 class GBlock(nn.Module):
+  # Constant so that TorchScript only compiles the branch in use
+  __constants__ = ['subpixel']
   def __init__(self, in_channels, out_channels,
                which_conv=nn.Conv2d, which_bn=layers.bn, activation=None,
-               upsample=None, channel_ratio=4):
+               upsample=None, channel_ratio=4, subpixel=False):
     super(GBlock, self).__init__()
     
     self.in_channels, self.out_channels = in_channels, out_channels
@@ -44,6 +46,8 @@ class GBlock(nn.Module):
     self.bn4 = self.which_bn(self.hidden_channels)
     # upsample layers
     self.upsample = upsample
+    # Fuse the (nearest) upsample into conv2 as a sub-pixel conv?
+    self.subpixel = subpixel
 
   def forward(self, x, y):
     # Project down to channel ratio
@@ -54,16 +58,34 @@ class GBlock(nn.Module):
     if self.in_channels != self.out_channels:
       x = x[:, :self.out_channels]      
     # Upsample both h and x at this point  
-    if self.upsample:
-      h = self.upsample(h)
+    if self.upsample is not None:
       x = self.upsample(x)
     # 3x3 convs
-    h = self.conv2(h)
+    if self.upsample is not None and self.subpixel:
+      h = layers.subpixel_conv(h, self.conv2)
+    else:
+      if self.upsample is not None:
+        h = self.upsample(h)
+      h = self.conv2(h)
     h = self.conv3(self.activation(self.bn3(h, y)))
     # Final 1x1 conv
     h = self.conv4(self.activation(self.bn4(h, y)))
     return h + x
 
+  # Fold this block for inference: bn1 becomes a ccaffine with its statistics
+  # folded in, the statistics of bn2-4 are folded into the preceding convs,
+  # and the activations are fused into the ccaffines. Must be called in eval
+  # mode under no_grad.
+  def fold(self):
+    self.bn1 = layers.fold_ccbn(self.bn1, self.activation)
+    for conv, bn in [('conv1', 'bn2'), ('conv2', 'bn3'), ('conv3', 'bn4')]:
+      setattr(self, conv, layers.fold_conv(getattr(self, conv), getattr(self, bn)))
+      setattr(self, bn, layers.fold_ccbn(getattr(self, bn), self.activation,
+                                         normalize=False))
+    self.conv4 = layers.fold_conv(self.conv4)
+    self.activation = layers.identity()
+    return self
+
 def G_arch(ch=64, attention='64', ksize='333333', dilation='111111'):
   arch = {}
   arch[256] = {'in_channels' :  [ch * item for item in [16, 16, 8, 8, 4, 2]],
@@ -103,8 +125,8 @@ class Generator(nn.Module):
                G_lr=5e-5, G_B1=0.0, G_B2=0.999, adam_eps=1e-8,
                BN_eps=1e-5, SN_eps=1e-12, G_mixed_precision=False, G_fp16=False,
                G_init='ortho', skip_init=False, no_optim=False,
-               G_param='SN', norm_style='bn',
-               **kwargs):
+               G_param='SN', norm_style='bn', channels_last=False,
+               G_subpixel=False, G_checkpoint='0', **kwargs):
     super(Generator, self).__init__()
     # Channel width mulitplier
     self.ch = G_ch
@@ -146,8 +168,15 @@ class Generator(nn.Module):
     self.SN_eps = SN_eps
     # fp16?
     self.fp16 = G_fp16
+    # Use channels_last memory format?
+    self.channels_last = channels_last
     # Architecture dict
     self.arch = G_arch(self.ch, self.attention)[resolution]
+    # Which blocks (by output resolution) to run under activation checkpointing;
+    # note that self.blocks has G_depth entries per resolution
+    self.checkpoint_blocks = [res in [int(item) for item in G_checkpoint.split('_')]
+                              for res in self.arch['resolution']
+                              for _ in range(self.G_depth)]
 
 
     # Which convs, batchnorms, and linear layers to use
@@ -195,7 +224,8 @@ class Generator(nn.Module):
                              which_conv=self.which_conv,
                              which_bn=self.which_bn,
                              activation=self.activation,
-                             upsample=(functools.partial(F.interpolate, scale_factor=2)
+                             subpixel=G_subpixel,
+                             upsample=(nn.Upsample(scale_factor=2)
                                        if self.arch['upsample'][index] and g_index == (self.G_depth-1) else None))]
                        for g_index in range(self.G_depth)]
 
@@ -219,6 +249,11 @@ class Generator(nn.Module):
     if not skip_init:
       self.init_weights()
 
+    # Convert conv weights to channels_last if requested; the convs will then
+    # also produce channels_last outputs.
+    if self.channels_last:
+      self.to(memory_format=torch.channels_last)
+
     # Set up optimizer
     # If this is an EMA copy, no need for an optim, so just return now
     if no_optim:
@@ -227,7 +262,9 @@ class Generator(nn.Module):
     if G_mixed_precision:
       print('Using fp16 adam in G...')
       import utils
-      self.optim = utils.Adam16(params=self.parameters(), lr=self.lr,
+      # FlatAdam16 only pays off on GPU, where kernel launches dominate
+      adam16 = utils.FlatAdam16 if torch.cuda.is_available() else utils.Adam16
+      self.optim = adam16(params=self.parameters(), lr=self.lr,
                            betas=(self.B1, self.B2), weight_decay=0,
                            eps=self.adam_eps)
     else:
@@ -257,6 +294,32 @@ class Generator(nn.Module):
         self.param_count += sum([p.data.nelement() for p in module.parameters()])
     print('Param count for G''s initialized parameters: %d' % self.param_count)
 
+  # Convert this Generator into an inference-only one, with its eval-mode BN
+  # statistics and spectral norms folded into plain weights, and activations
+  # fused into the class-conditional affines. The result matches the eval-mode
+  # output of the original G, and cannot be trained further.
+  def fold(self):
+    self.eval()
+    with torch.no_grad():
+      self.linear = layers.fold_linear(self.linear)
+      for blocklist in self.blocks:
+        for block in blocklist:
+          block.fold()
+      self.output_layer = nn.Sequential(
+        layers.fold_bn(self.output_layer[0], self.activation),
+        layers.fold_conv(self.output_layer[2]))
+    return self
+
+  # Run the index-th set of blocks under activation checkpointing
+  @torch.jit.unused
+  def checkpointed(self, index, h, y):
+    # type: (int, Tensor, Tensor) -> Tensor
+    def run(h, y):
+      for block in self.blocks[index]:
+        h = block(h, y)
+      return h
+    return layers.checkpoint(run, h, y)
+
   # Note on this forward function: we pass in a y vector which has
   # already been passed through G.shared to enable easy class-wise
   # interpolation later. If we passed in the one-hot and then ran it through
@@ -270,12 +333,18 @@ class Generator(nn.Module):
     # First linear layer
     h = self.linear(z)
     # Reshape
-    h = h.view(h.size(0), -1, self.bottom_width, self.bottom_width)    
+    h = h.view(h.size(0), -1, self.bottom_width, self.bottom_width)
+    if self.channels_last:
+      h = h.contiguous(memory_format=torch.channels_last)    
     # Loop over blocks
     for index, blocklist in enumerate(self.blocks):
-      # Second inner loop in case block has multiple layers
-      for block in blocklist:
-        h = block(h, y)
+      # Recompute this block's activations in backward instead of storing them?
+      if self.checkpoint_blocks[index] and self.training and torch.is_grad_enabled():
+        h = self.checkpointed(index, h, y)
+      else:
+        # Second inner loop in case block has multiple layers
+        for block in blocklist:
+          h = block(h, y)
         
     # Apply batchnorm-relu-conv-tanh at output
     return torch.tanh(self.output_layer(h))
@@ -363,8 +432,14 @@ class Discriminator(nn.Module):
                num_D_SVs=1, num_D_SV_itrs=1, D_activation=nn.ReLU(inplace=False),
                D_lr=2e-4, D_B1=0.0, D_B2=0.999, adam_eps=1e-8,
                SN_eps=1e-12, output_dim=1, D_mixed_precision=False, D_fp16=False,
-               D_init='ortho', skip_init=False, D_param='SN', **kwargs):
+               D_init='ortho', skip_init=False, D_param='SN',
+               channels_last=False, D_fused_pool=False,
+               D_checkpoint='0', **kwargs):
     super(Discriminator, self).__init__()
+    # These DBlocks apply an activation between their last 3x3 conv and the
+    # pooling, so the two can't be fused
+    if D_fused_pool:
+      raise ValueError('D_fused_pool is not supported by BigGANdeep')
     # Width multiplier
     self.ch = D_ch
     # Use Wide D as in BigGAN and SA-GAN or skinny D as in SN-GAN?
@@ -389,8 +464,13 @@ class Discriminator(nn.Module):
     self.SN_eps = SN_eps
     # Fp16?
     self.fp16 = D_fp16
+    # Use channels_last memory format?
+    self.channels_last = channels_last
     # Architecture
     self.arch = D_arch(self.ch, self.attention)[resolution]
+    # Which blocks (by output resolution) to run under activation checkpointing
+    self.checkpoint_blocks = [res in [int(item) for item in D_checkpoint.split('_')]
+                              for res in self.arch['resolution']]
 
 
     # Which convs, batchnorms, and linear layers to use
@@ -440,12 +520,18 @@ class Discriminator(nn.Module):
     if not skip_init:
       self.init_weights()
 
+    # Convert conv weights to channels_last if requested; the convs will then
+    # also produce channels_last outputs.
+    if self.channels_last:
+      self.to(memory_format=torch.channels_last)
+
     # Set up optimizer
     self.lr, self.B1, self.B2, self.adam_eps = D_lr, D_B1, D_B2, adam_eps
     if D_mixed_precision:
       print('Using fp16 adam in D...')
       import utils
-      self.optim = utils.Adam16(params=self.parameters(), lr=self.lr,
+      adam16 = utils.FlatAdam16 if torch.cuda.is_available() else utils.Adam16
+      self.optim = adam16(params=self.parameters(), lr=self.lr,
                              betas=(self.B1, self.B2), weight_decay=0, eps=self.adam_eps)
     else:
       self.optim = optim.Adam(params=self.parameters(), lr=self.lr,
@@ -472,13 +558,25 @@ class Discriminator(nn.Module):
         self.param_count += sum([p.data.nelement() for p in module.parameters()])
     print('Param count for D''s initialized parameters: %d' % self.param_count)
 
+  # Run the index-th set of blocks under activation checkpointing
+  def checkpointed(self, index, h):
+    def run(h):
+      for block in self.blocks[index]:
+        h = block(h)
+      return h
+    return layers.checkpoint(run, h)
+
   def forward(self, x, y=None):
     # Run input conv
     h = self.input_conv(x)
     # Loop over blocks
     for index, blocklist in enumerate(self.blocks):
-      for block in blocklist:
-        h = block(h)
+      # Recompute this block's activations in backward instead of storing them?
+      if self.checkpoint_blocks[index] and self.training and torch.is_grad_enabled():
+        h = self.checkpointed(index, h)
+      else:
+        for block in blocklist:
+          h = block(h)
     # Apply global sum pooling as in SN-GAN
     h = torch.sum(self.activation(h), [2, 3])
     # Get initial class-unconditional output
@@ -0,0 +1,215 @@
+''' Benchmark
+   This script times G and D's forward and backward passes and full training
+   steps on random data, for each model and resolution requested, and writes
+   the results as JSON so that they can be compared between commits.
+   All other settings (G_ch, attention, norm_style, mybn, hier, ...) are
+   taken from the usual training flags, e.g.
+   python benchmark.py --bench_models BigGAN_BigGANdeep --bench_resolutions 32_64
+     --G_ch 16 --D_ch 16 --batch_size 8 --G_shared --hier --bench_device cpu '''
+import os
+import sys
+import json
+import time
+import resource
+import subprocess
+import numpy as np
+
+import torch
+
+# Import my stuff
+import utils
+import train_fns
+
+
+# Get the current commit, if we're in a git repo
+def get_commit():
+  try:
+    return subprocess.check_output(
+      ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+      cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+  except Exception:
+    return None
+
+
+# Reset the peak memory counter: GPU allocations, or on CPU the process's
+# RSS high-water mark, which Linux resets when 5 is written to clear_refs
+def reset_peak_memory(device):
+  if device == 'cuda':
+    torch.cuda.reset_peak_memory_stats()
+    return
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+  except OSError:
+    pass
+
+
+# Peak memory in MB since the last reset: allocated memory on GPU, or the
+# process's peak RSS on CPU. Where the RSS high-water mark can't be reset
+# or read (outside Linux), this is the peak RSS over the whole process.
+def peak_memory(device):
+  if device == 'cuda':
+    return torch.cuda.max_memory_allocated() / 2 ** 20
+  try:
+    with open('/proc/self/status') as f:
+      for line in f:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) / 2 ** 10
+  except OSError:
+    pass
+  # ru_maxrss is in KB on Linux
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+# Time fn over itrs iterations after warmup, and report its median time,
+# its iterations and images per second, and peak memory.
+def time_fn(fn, images, config, device):
+  def sync():
+    if device == 'cuda':
+      torch.cuda.synchronize()
+  for _ in range(config['bench_warmup']):
+    fn()
+  sync()
+  reset_peak_memory(device)
+  times = []
+  for _ in range(config['bench_itrs']):
+    start = time.perf_counter()
+    fn()
+    sync()
+    times.append(time.perf_counter() - start)
+  median = float(np.median(times))
+  return {'ms_p50': 1000 * median, 'ms_min': 1000 * float(np.min(times)),
+          'it_per_s': 1 / median, 'images_per_s': images / median,
+          'peak_mem_mb': peak_memory(device)}
+
+
+# Build G, D and the training function the way train.py does, for one model
+# and resolution, and time each of the benchmarks.
+def benchmark(config, device):
+  model = __import__(config['model'])
+  G = model.Generator(**config).to(device)
+  D = model.Discriminator(**config).to(device)
+  if config['ema']:
+    G_ema = model.Generator(**{**config, 'skip_init': True,
+                               'no_optim': True}).to(device)
+    ema = utils.ema(G, G_ema, config['ema_decay'], config['ema_start'])
+  else:
+    G_ema, ema = None, None
+  if config['G_fp16']:
+    G = G.half()
+    if config['ema']:
+      G_ema = G_ema.half()
+  if config['D_fp16']:
+    D = D.half()
+  if config['flat_params']:
+    G.flat = utils.FlatParams(G)
+    D.flat = utils.FlatParams(D)
+    if config['ema']:
+      G_ema.flat = utils.FlatParams(G_ema)
+  GD = model.G_D(G, D)
+  if config['compile']:
+    GD = torch.compile(GD)
+  memory_format = (torch.channels_last if config['channels_last']
+                   else torch.preserve_format)
+  state_dict = {'itr': 0, 'epoch': 0, 'config': config}
+
+  batch_size = config['batch_size']
+  G_batch_size = max(config['G_batch_size'], batch_size)
+  z_, y_ = utils.prepare_z_y(G_batch_size, G.dim_z, config['n_classes'],
+                             device=device, fp16=config['G_fp16'])
+  z_.sample_()
+  y_.sample_()
+  z, y = z_[:batch_size], y_[:batch_size]
+  x = torch.randn(batch_size, 3, config['resolution'], config['resolution'],
+                  device=device).to(memory_format=memory_format)
+  if config['D_fp16']:
+    x = x.half()
+
+  out = {'G_params': sum([p.data.nelement() for p in G.parameters()]),
+         'D_params': sum([p.data.nelement() for p in D.parameters()])}
+  G.train()
+  D.train()
+  def G_forward():
+    with torch.no_grad():
+      G(z, G.shared(y))
+  def G_forward_backward():
+    G(z, G.shared(y)).float().mean().backward()
+  def D_forward():
+    with torch.no_grad():
+      D(x, y)
+  def D_forward_backward():
+    D(x, y).float().mean().backward()
+  for name, fn in [('G_forward', G_forward),
+                   ('G_forward_backward', G_forward_backward),
+                   ('D_forward', D_forward),
+                   ('D_forward_backward', D_forward_backward)]:
+    out[name] = time_fn(fn, batch_size, config, device)
+    utils.zero_grad(G)
+    utils.zero_grad(D)
+
+  # A full training step consumes this many real images
+  D_batch_size = (batch_size * config['num_D_steps']
+                  * config['num_D_accumulations'])
+  x = torch.randn(D_batch_size, 3, config['resolution'], config['resolution'],
+                  device=device).to(memory_format=memory_format)
+  y = torch.randint(0, config['n_classes'], (D_batch_size,), device=device)
+  if config['D_fp16']:
+    x = x.half()
+  train = train_fns.GAN_training_function(G, D, GD, z_, y_, ema, state_dict,
+                                          config)
+  def train_step():
+    state_dict['itr'] += 1
+    train(x, y)
+  out['train_step'] = time_fn(train_step, D_batch_size, config, device)
+  return out
+
+
+def run(config):
+  # Update the config dict as train.py does, other than the resolution
+  config['n_classes'] = utils.nclass_dict[config['dataset']]
+  config['G_activation'] = utils.activation_dict[config['G_nl']]
+  config['D_activation'] = utils.activation_dict[config['D_nl']]
+  config['skip_init'] = True
+  device = config['bench_device'] or ('cuda' if torch.cuda.is_available()
+                                      else 'cpu')
+  torch.backends.cudnn.benchmark = True
+
+  results = {'commit': get_commit(), 'torch': torch.__version__,
+             'device': device, 'argv': sys.argv[1:], 'results': []}
+  for model in config['bench_models'].split('_'):
+    for resolution in [int(item) for item in config['bench_resolutions'].split('_')]:
+      print('Benchmarking %s at %d...' % (model, resolution))
+      utils.seed_rng(config['seed'])
+      result = {'model': model, 'resolution': resolution}
+      # Record a failing configuration (e.g. an unsupported resolution)
+      # and carry on with the sweep, but fail the run at the end
+      try:
+        result.update(benchmark({**config, 'model': model,
+                                 'resolution': resolution}, device))
+      except Exception as e:
+        print('Failed: %s' % e)
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+      results['results'].append(result)
+      if device == 'cuda':
+        torch.cuda.empty_cache()
+
+  print(json.dumps(results, indent=2))
+  if config['bench_out']:
+    with open(config['bench_out'], 'w') as f:
+      json.dump(results, f, indent=2)
+    print('Results written to %s' % config['bench_out'])
+  failures = ['%s at %d' % (result['model'], result['resolution'])
+              for result in results['results'] if 'error' in result]
+  if failures:
+    sys.exit('Benchmarks failed: %s' % ', '.join(failures))
+
+
+def main():
+  # parse command line and run
+  parser = utils.prepare_parser()
+  parser = utils.add_benchmark_parser(parser)
+  config = vars(parser.parse_args())
+  run(config)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,83 @@
+''' Ortho reg benchmark
+   This script times utils.ortho_reg, the precomputed and batched modified
+   ortho reg that training uses, against the per-parameter utils.ortho it
+   replaced and utils.default_ortho, on the G and D built from the usual
+   training flags (with --G_ortho as the strength, or 1e-4 if it is 0). It
+   also checks that ortho_reg adds the same grads as utils.ortho, and
+   prints the results as JSON, e.g.
+   python benchmark_ortho.py --model BigGANdeep --G_ch 32 --D_ch 32
+     --G_shared --hier --shared_dim 32 --dataset I128_hdf5 '''
+import json
+import time
+import numpy as np
+
+import torch
+
+# Import my stuff
+import utils
+
+
+# Time fn over itrs iterations after warmup, and return its median in ms
+def time_fn(fn, device, itrs=10, warmup=2):
+  def sync():
+    if device == 'cuda':
+      torch.cuda.synchronize()
+  for _ in range(warmup):
+    fn()
+  sync()
+  times = []
+  for _ in range(itrs):
+    start = time.perf_counter()
+    fn()
+    sync()
+    times.append(time.perf_counter() - start)
+  return 1000 * float(np.median(times))
+
+
+def run(config):
+  # Update the config dict as train.py does
+  config['resolution'] = utils.imsize_dict[config['dataset']]
+  config['n_classes'] = utils.nclass_dict[config['dataset']]
+  config['G_activation'] = utils.activation_dict[config['G_nl']]
+  config['D_activation'] = utils.activation_dict[config['D_nl']]
+  config['skip_init'] = True
+  device = 'cuda' if torch.cuda.is_available() else 'cpu'
+  strength = config['G_ortho'] or 1e-4
+  model = __import__(config['model'])
+  utils.seed_rng(config['seed'])
+  results = {'device': device, 'strength': strength}
+  for name, net in [('G', model.Generator(**config).to(device)),
+                    ('D', model.Discriminator(**config).to(device))]:
+    blacklist = ([param for param in net.shared.parameters()]
+                 if name == 'G' else [])
+    plan = utils.ortho_reg(net, strength, blacklist)
+    # Check the grads against utils.ortho's, from zero
+    grads = {}
+    for key, fn in [('ortho', lambda: utils.ortho(net, strength, blacklist)),
+                    ('ortho_reg', plan)]:
+      for param in net.parameters():
+        param.grad = torch.zeros_like(param)
+      fn()
+      grads[key] = [param.grad.clone() for param in net.parameters()]
+    rel_diff = max([float((a - b).abs().max() / b.abs().max().clamp(min=1e-30))
+                    for a, b in zip(grads['ortho_reg'], grads['ortho'])])
+    results[name] = {
+      'params': len(list(net.parameters())),
+      'groups': len(plan.groups),
+      'max_rel_diff': rel_diff,
+      'ortho_ms': time_fn(lambda: utils.ortho(net, strength, blacklist), device),
+      # default_ortho compares its blacklist by value, which fails on
+      # tensors of other shapes, so it is timed without one
+      'default_ortho_ms': time_fn(lambda: utils.default_ortho(net, strength), device),
+      'ortho_reg_ms': time_fn(plan, device)}
+  print(json.dumps(results, indent=2))
+
+
+def main():
+  # parse command line and run
+  parser = utils.prepare_parser()
+  config = vars(parser.parse_args())
+  run(config)
+
+if __name__ == '__main__':
+  main()
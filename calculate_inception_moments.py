@@ -5,10 +5,24 @@
  
  Note that if you don't shuffle the data, the IS of true data will be under-
  estimated as it is label-ordered. By default, the data is not shuffled
- so as to reduce non-determinism. '''
+ so as to reduce non-determinism.
+
+ The moments are accumulated in float64 as the data streams through, so the
+ activations are never held in memory. The data can be split into shards
+ (--num_shards), which run one after another or one per device at once
+ (--devices cuda:0_cuda:1), or one at a time with --shard, e.g. as separate
+ jobs. Each shard's partial moments are checkpointed to disk every
+ --checkpoint_every batches, so an interrupted run resumes where it left off
+ and a finished shard is not recomputed, and once all shards are done their
+ moments are merged exactly and the checkpoints are deleted. A checkpoint
+ made with different settings (e.g. --shuffle or --seed) is refused rather
+ than resumed. '''
+import os
 import numpy as np
 import torch
 import torch.nn.functional as F
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, Subset
 import utils
 import inception_utils
 from tqdm import tqdm
@@ -24,6 +38,10 @@ def prepare_parser():
   parser.add_argument(
     '--data_root', type=str, default='data',
     help='Default location where data is stored (default: %(default)s)') 
+  parser.add_argument(
+    '--moments_root', type=str, default='moments',
+    help='Default location to store datasets\' Inception moments '
+         '(default: %(default)s)')
   parser.add_argument(
     '--batch_size', type=int, default=64,
     help='Default overall batchsize (default: %(default)s)')
@@ -42,40 +60,178 @@ def prepare_parser():
   parser.add_argument(
     '--seed', type=int, default=0,
     help='Random seed to use.')
+  parser.add_argument(
+    '--num_shards', type=int, default=0,
+    help='Number of shards to split the data into; 0 for one per device '
+         '(default: %(default)s)')
+  parser.add_argument(
+    '--shard', type=int, default=-1,
+    help='Only calculate this shard\'s moments and exit, rather than '
+         'calculating all shards and merging them (default: %(default)s)')
+  parser.add_argument(
+    '--devices', type=str, default='',
+    help='Devices to run the shards on, one process each, separated by '
+         'underscores, e.g. cuda:0_cuda:1; cuda if available and cpu '
+         'otherwise if not specified (default: %(default)s)')
+  parser.add_argument(
+    '--checkpoint_every', type=int, default=500,
+    help='Checkpoint each shard\'s moments every X batches '
+         '(default: %(default)s)')
+  parser.add_argument(
+    '--num_real_features', type=int, default=0,
+    help='Number of randomly chosen images to keep the pool features of, '
+         'for KID, precision/recall and density/coverage (--extra_metrics), '
+         'e.g. 50000, which takes about 400MB; 0 to keep none '
+         '(default: %(default)s)')
   return parser
 
-def run(config):
-  # Get loader
-  config['drop_last'] = False
-  loaders = utils.get_data_loaders(**config)
+# The file a shard's moments are checkpointed to
+def shard_filename(config, shard):
+  return '%s_inception_moments_shard%dof%d.pth' % (config['dataset'], shard,
+                                                   config['num_shards'])
 
-  # Load inception net
-  net = inception_utils.load_inception_net(parallel=config['parallel'])
-  pool, logits, labels = [], [], []
-  device = 'cuda'
-  for i, (x, y) in enumerate(tqdm(loaders[0])):
+
+# The settings a shard's moments depend on, including the dataset's
+# fingerprint, which are saved with its checkpoint and must match for it to
+# be resumed or merged
+def shard_settings(config):
+  return {item: config[item] for item in ['dataset', 'fingerprint',
+                                          'num_shards', 'shuffle', 'seed',
+                                          'augment', 'num_real_features']}
+
+
+# Load a shard's checkpointed moments, refusing ones made with other settings
+def load_shard(config, shard, device):
+  checkpoint = torch.load(shard_filename(config, shard), map_location=device)
+  if checkpoint['settings'] != shard_settings(config):
+    raise ValueError('%s was made with settings %s, not %s; delete it to '
+                     'recalculate the shard'
+                     % (shard_filename(config, shard), checkpoint['settings'],
+                        shard_settings(config)))
+  return checkpoint['stats']
+
+
+# Split the (optionally shuffled) data into contiguous shards, and return the
+# offset and indices of the given shard. The shuffle is seeded so that every
+# process and every resumed run sees the same order.
+def shard_indices(num_images, shard, config):
+  if config['shuffle']:
+    generator = torch.Generator().manual_seed(config['seed'])
+    indices = torch.randperm(num_images, generator=generator)
+  else:
+    indices = torch.arange(num_images)
+  start = num_images * shard // config['num_shards']
+  end = num_images * (shard + 1) // config['num_shards']
+  return start, indices[start:end]
+
+
+# Mark num_real_features randomly chosen images (by their position in the
+# shards) to keep the pool features of, or None to keep none
+def feature_mask(num_images, config):
+  if not config['num_real_features']:
+    return None
+  generator = torch.Generator().manual_seed(config['seed'])
+  keep = torch.zeros(num_images, dtype=torch.bool)
+  keep[torch.randperm(num_images, generator=generator)[:config['num_real_features']]] = True
+  return keep
+
+
+# Calculate one shard's moments, resuming from its checkpoint
+def run_shard(config, shard, dataset, net, device):
+  start, indices = shard_indices(len(dataset), shard, config)
+  stats = inception_utils.InceptionStats(10, len(dataset), start,
+                                         feature_mask(len(dataset), config))
+  if os.path.exists(shard_filename(config, shard)):
+    stats.load_state_dict(load_shard(config, shard, device))
+  if stats.n == len(indices):
+    print('Shard %d of %d is already done.' % (shard, config['num_shards']))
+    return stats
+  if stats.n:
+    print('Resuming shard %d of %d from image %d of %d...'
+          % (shard, config['num_shards'], stats.n, len(indices)))
+  loader = DataLoader(Subset(dataset, indices[stats.n:].tolist()),
+                      batch_size=config['batch_size'], shuffle=False,
+                      num_workers=config['num_workers'], pin_memory=True)
+  # Write to a temporary file and rename it, so that an interruption while
+  # saving can't corrupt the checkpoint
+  def checkpoint():
+    torch.save({'settings': shard_settings(config),
+                'stats': stats.state_dict()},
+               shard_filename(config, shard) + '.tmp')
+    os.replace(shard_filename(config, shard) + '.tmp',
+               shard_filename(config, shard))
+  for i, (x, y) in enumerate(tqdm(loader)):
     x = x.to(device)
     with torch.no_grad():
       pool_val, logits_val = net(x)
-      pool += [np.asarray(pool_val.cpu())]
-      logits += [np.asarray(F.softmax(logits_val, 1).cpu())]
-      labels += [np.asarray(y.cpu())]
-
-  pool, logits, labels = [np.concatenate(item, 0) for item in [pool, logits, labels]]
-  # uncomment to save pool, logits, and labels to disk
-  # print('Saving pool, logits, and labels to disk...')
-  # np.savez(config['dataset']+'_inception_activations.npz',
-  #           {'pool': pool, 'logits': logits, 'labels': labels})
+      stats.update(pool_val, F.softmax(logits_val, 1))
+    if not (i + 1) % config['checkpoint_every']:
+      checkpoint()
+  checkpoint()
+  return stats
+
+
+# Calculate the given shards' moments on one device
+def run_shards(config, shards, device):
+  # Get the dataset; shards are loaded in a fixed order from it
+  config['drop_last'] = False
+  dataset = utils.get_data_loaders(**config)[0].dataset
+  # Load inception net
+  net = inception_utils.load_inception_net(parallel=config['parallel'],
+                                           device=device)
+  for shard in shards:
+    run_shard(config, shard, dataset, net, device)
+
+
+# The entry point for each process when running on several devices
+def run_device(index, config, devices):
+  run_shards(config, range(index, config['num_shards'], len(devices)),
+             devices[index])
+
+
+def run(config):
+  devices = (config['devices'].split('_') if config['devices']
+             else ['cuda' if torch.cuda.is_available() else 'cpu'])
+  config['num_shards'] = config['num_shards'] or len(devices)
+  config['fingerprint'] = utils.dataset_fingerprint(**config)
+  if config['shard'] >= 0:
+    run_shards(config, [config['shard']], devices[0])
+    return
+  if len(devices) > 1:
+    mp.spawn(run_device, args=(config, devices), nprocs=len(devices))
+  else:
+    run_shards(config, range(config['num_shards']), devices[0])
+
+  # Merge the shards' moments
+  stats = None
+  for shard in range(config['num_shards']):
+    shard_stats = inception_utils.InceptionStats()
+    shard_stats.load_state_dict(load_shard(config, shard, 'cpu'))
+    if stats is None:
+      stats = inception_utils.InceptionStats(shard_stats.num_splits,
+                                             shard_stats.num_images)
+    stats.merge(shard_stats)
+  if stats.n != stats.num_images:
+    raise ValueError('Shards cover %d of %d images' % (stats.n, stats.num_images))
   # Calculate inception metrics and report them
   print('Calculating inception metrics...')
-  IS_mean, IS_std = inception_utils.calculate_inception_score(logits)
+  IS_mean, IS_std = stats.inception_score()
   print('Training data from dataset %s has IS of %5.5f +/- %5.5f' % (config['dataset'], IS_mean, IS_std))
-  # Prepare mu and sigma, save to disk. Remove "hdf5" by default 
-  # (the FID code also knows to strip "hdf5")
+  # Prepare mu and sigma, save to disk, both to the moments store under the
+  # dataset's fingerprint (with the kept features) and as a moments file
+  # without "hdf5" in its name (the FID code falls back to that if the data
+  # isn't around to fingerprint)
   print('Calculating means and covariances...')
-  mu, sigma = np.mean(pool, axis=0), np.cov(pool, rowvar=False)
+  mu, sigma = [item.numpy() for item in stats.moments()]
   print('Saving calculated means and covariances to disk...')
-  np.savez(config['dataset'].strip('_hdf5')+'_inception_moments.npz', **{'mu' : mu, 'sigma' : sigma})
+  if config['fingerprint'] is not None:
+    print('Saved to %s' % inception_utils.MomentsStore(config['moments_root']).save(
+      config['dataset'], config['fingerprint'], mu, sigma,
+      torch.cat(stats.features).numpy() if stats.features else None))
+  np.savez(inception_utils.moments_filename(config['dataset']), **{'mu' : mu, 'sigma' : sigma})
+  # The shards' checkpoints are no longer needed
+  for shard in range(config['num_shards']):
+    os.remove(shard_filename(config, shard))
 
 def main():
   # parse command line    
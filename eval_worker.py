@@ -0,0 +1,227 @@
+''' Eval worker
+   This script watches for the weight snapshots train.py writes with
+   --async_eval, and for each one computes inception metrics, sample sheets,
+   interp sheets and optionally truncation curves, on its own device. It logs
+   the metrics to the experiment's _log.jsonl (and any extra metrics and the
+   truncation curves to its _extra_log.jsonl and _trunc_log.jsonl) and keeps
+   the best copies of the weights, so the training loop only has to snapshot
+   them. Run it with the same arguments as train.py, plus any of sample.py's,
+   e.g.
+   python eval_worker.py <train.py args> --sample_trunc_curves 0.2_0.1_1.0 '''
+import os
+import re
+import glob
+import json
+import time
+import shutil
+import functools
+import numpy as np
+
+import torch
+import torchvision
+
+# Import my stuff
+import inception_utils
+import utils
+
+
+# The files a checkpoint or snapshot can have for a given suffix
+def weight_files(root, name_suffix):
+  return ['%s/%s.pth' % (root, utils.join_strings('_', [item, name_suffix]))
+          for item in ['G', 'G_optim', 'D', 'D_optim', 'state_dict', 'G_ema']]
+
+
+# The itrs of the snapshots that are ready to evaluate, oldest first
+def ready_snapshots(root):
+  itrs = []
+  for fname in glob.glob('%s/eval*.ready' % root):
+    match = re.match(r'eval(\d+)\.ready$', os.path.basename(fname))
+    if match:
+      itrs += [int(match.group(1))]
+  return sorted(itrs)
+
+
+def run(config):
+  # update config (see train.py for explanation)
+  config['resolution'] = utils.imsize_dict[config['dataset']]
+  config['n_classes'] = utils.nclass_dict[config['dataset']]
+  config['G_activation'] = utils.activation_dict[config['G_nl']]
+  config['D_activation'] = utils.activation_dict[config['D_nl']]
+  config = utils.update_config_roots(config)
+  config['skip_init'] = True
+  config['no_optim'] = True
+  # The worker runs on one device
+  config['parallel'] = False
+  device = config['eval_device'] or ('cuda' if torch.cuda.is_available()
+                                     else 'cpu')
+
+  # Seed RNG
+  utils.seed_rng(config['seed'])
+
+  # Setup cudnn.benchmark for free speed
+  torch.backends.cudnn.benchmark = True
+
+  # Import the model--this line allows us to dynamically select different files.
+  model = __import__(config['model'])
+  experiment_name = (config['experiment_name'] if config['experiment_name']
+                       else utils.name_from_config(config))
+  print('Experiment name is %s' % experiment_name)
+  root = '%s/%s' % (config['weights_root'], experiment_name)
+
+  # The worker's record of the best metrics, kept across restarts
+  state_fname = '%s/eval_worker_state.json' % root
+  state = {'best_IS': 0, 'best_FID': 999999, 'save_best_num': 0}
+  if os.path.exists(state_fname):
+    with open(state_fname) as f:
+      state.update(json.load(f))
+
+  G = model.Generator(**config).to(device)
+  if config['G_fp16']:
+    G = G.half()
+  which_G = 'G_ema' if config['ema'] and config['use_ema'] else 'G'
+  G_batch_size = max(config['G_batch_size'], config['batch_size'])
+  z_, y_ = utils.prepare_z_y(G_batch_size, G.dim_z, config['n_classes'],
+                             device=device, fp16=config['G_fp16'],
+                             z_var=config['z_var'])
+  # Prepare a fixed z & y to see individual sample evolution throghout training
+  fixed_z, fixed_y = utils.prepare_z_y(G_batch_size, G.dim_z,
+                                       config['n_classes'], device=device,
+                                       fp16=config['G_fp16'])
+  fixed_z.sample_()
+  fixed_y.sample_()
+  sample = functools.partial(utils.sample, G=G, z_=z_, y_=y_, config=config)
+  get_inception_metrics = inception_utils.prepare_inception_metrics(
+    config['dataset'], False, config['no_fid'], config['channels_last'],
+    config['inception_batch_size'], config['pipeline_inception'],
+    config['fid_backend'], config['inception_fp16'], config['resolution'],
+    device, utils.dataset_fingerprint(**config), config['moments_root'],
+    config['extra_metrics'], config['knn_k'], config['kid_subsets'],
+    config['kid_subset_size'])
+  test_log = utils.MetricsLogger('%s/%s_log.jsonl' % (config['logs_root'],
+                                                     experiment_name),
+                                 reinitialize=False)
+  # Extra metrics and truncation curves get their own logs, leaving the test
+  # log's format as it was for the tools that parse it
+  extra_log = utils.MetricsLogger('%s/%s_extra_log.jsonl'
+                                  % (config['logs_root'], experiment_name),
+                                  reinitialize=False)
+  trunc_log = utils.MetricsLogger('%s/%s_trunc_log.jsonl'
+                                  % (config['logs_root'], experiment_name),
+                                  reinitialize=False)
+
+  # Put G in the mode used for testing, with standing stats if requested
+  def prepare_G():
+    if config['G_eval_mode']:
+      G.eval()
+    else:
+      G.train()
+    if config['accumulate_stats']:
+      utils.accumulate_standing_stats(G, z_, y_, config['n_classes'],
+                                      config['num_standing_accumulations'])
+
+  def evaluate(itr):
+    name_suffix = 'eval%d' % itr
+    print('Evaluating the snapshot from itr %d...' % itr)
+    G.load_state_dict(torch.load('%s/%s.pth' % (root, utils.join_strings(
+      '_', [which_G, name_suffix])), map_location=device))
+    prepare_G()
+
+    # Save a random sample sheet with fixed z and y, and sample and interp
+    # sheets, as save_and_sample does
+    with torch.no_grad():
+      fixed_Gz = G(fixed_z, G.shared(fixed_y))
+    if not os.path.isdir('%s/%s' % (config['samples_root'], experiment_name)):
+      os.mkdir('%s/%s' % (config['samples_root'], experiment_name))
+    image_filename = '%s/%s/fixed_samples%d.jpg' % (config['samples_root'],
+                                                    experiment_name, itr)
+    torchvision.utils.save_image(fixed_Gz.float().cpu(), image_filename,
+                                 nrow=int(fixed_Gz.shape[0] **0.5),
+                                 normalize=True)
+    utils.sample_sheet(G,
+                       classes_per_sheet=utils.classes_per_sheet_dict[config['dataset']],
+                       num_classes=config['n_classes'],
+                       samples_per_class=10, parallel=False,
+                       samples_root=config['samples_root'],
+                       experiment_name=experiment_name,
+                       folder_number=itr, z_=z_, device=device)
+    for fix_z, fix_y in zip([False, False, True], [False, True, False]):
+      utils.interp_sheet(G, num_per_sheet=16, num_midpoints=8,
+                         num_classes=config['n_classes'], parallel=False,
+                         samples_root=config['samples_root'],
+                         experiment_name=experiment_name,
+                         folder_number=itr, sheet_number=0,
+                         fix_z=fix_z, fix_y=fix_y, device=device)
+
+    # Get inception metrics, and keep a best copy if they improved, as test does
+    IS_mean, IS_std, FID, extra = get_inception_metrics(
+      sample, config['num_inception_images'], num_splits=10,
+      return_extra=True)
+    print('Itr %d: PYTORCH UNOFFICIAL Inception Score is %3.3f +/- %3.3f, PYTORCH UNOFFICIAL FID is %5.4f' % (itr, IS_mean, IS_std, FID))
+    if extra:
+      print('Itr %d: %s' % (itr, ', '.join(['%s is %5.4f' % item for item in sorted(extra.items())])))
+    if ((config['which_best'] == 'IS' and IS_mean > state['best_IS'])
+      or (config['which_best'] == 'FID' and FID < state['best_FID'])):
+      print('%s improved over previous best, saving checkpoint...' % config['which_best'])
+      for source, dest in zip(weight_files(root, name_suffix),
+                              weight_files(root, 'best%d' % state['save_best_num'])):
+        if os.path.exists(source):
+          shutil.copyfile(source, dest)
+      state['save_best_num'] = (state['save_best_num'] + 1 ) % config['num_best_copies']
+    state['best_IS'] = max(state['best_IS'], float(IS_mean))
+    state['best_FID'] = min(state['best_FID'], float(FID))
+    test_log.log(itr=int(itr), IS_mean=float(IS_mean),
+                 IS_std=float(IS_std), FID=float(FID))
+    if extra:
+      extra_log.log(itr=int(itr), **extra)
+
+    # Optionally get metrics along a truncation curve, as sample.py does with
+    # --batched_trunc_curves, getting all the points at once from the same
+    # z and y and the standing stats accumulated above
+    if config['sample_trunc_curves']:
+      start, step, end = [float(item) for item in config['sample_trunc_curves'].split('_')]
+      variances = np.arange(start, end + step, step)
+      sample_curve = functools.partial(
+        utils.sample_curve, G=G, z_=z_, y_=y_, variances=variances,
+        config=config, fused_batch_size=config['trunc_fused_batch_size'])
+      metrics = get_inception_metrics(
+        sample_curve, utils.trunc_curve_images(config, len(variances)),
+        num_splits=10, prints=False, curve=True)
+      for var, (IS_mean, IS_std, FID) in zip(variances, metrics):
+        print('Itr %d, noise variance %3.3f: Inception Score is %3.3f +/- %3.3f, FID is %5.4f' % (itr, var, IS_mean, IS_std, FID))
+        trunc_log.log(itr=int(itr), z_var=float(var),
+                      trunc_IS_mean=float(IS_mean),
+                      trunc_IS_std=float(IS_std), trunc_FID=float(FID))
+
+    # Record the results before removing the snapshot, so that a worker that
+    # dies part way through redoes the snapshot rather than losing it. The
+    # file is replaced whole, as the trainer reads it when it snapshots.
+    with open(state_fname + '.tmp', 'w') as f:
+      json.dump(state, f)
+    os.replace(state_fname + '.tmp', state_fname)
+    for fname in weight_files(root, name_suffix):
+      if os.path.exists(fname):
+        os.remove(fname)
+    os.remove('%s/%s.ready' % (root, name_suffix))
+
+  print('Watching %s for snapshots...' % root)
+  while True:
+    itrs = ready_snapshots(root)
+    for itr in itrs:
+      evaluate(itr)
+    if config['eval_once']:
+      break
+    if not itrs:
+      time.sleep(config['eval_poll_interval'])
+
+
+def main():
+  # parse command line and run
+  parser = utils.prepare_parser()
+  parser = utils.add_sample_parser(parser)
+  parser = utils.add_eval_worker_parser(parser)
+  config = vars(parser.parse_args())
+  print(config)
+  run(config)
+
+if __name__ == '__main__':
+  main()
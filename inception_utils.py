@@ -1,7 +1,8 @@
 ''' Inception utilities
     This file contains methods for calculating IS and FID, using either
     the original numpy code or an accelerated fully-pytorch version that 
-    uses a fast newton-schulz approximation for the matrix sqrt. There are also
+    uses a fast newton-schulz approximation for the matrix sqrt, or an exact
+    one that uses a symmetric eigendecomposition. There are also
     methods for acquiring a desired number of samples from the Generator,
     and parallelizing the inbuilt PyTorch inception network.
     
@@ -11,6 +12,11 @@
     numbers. This code tends to produce IS values that are 5-10% lower than
     those obtained through TF. 
 '''    
+import os
+import math
+import queue
+import shutil
+import threading
 import numpy as np
 from scipy import linalg # For numpy FID
 import torch
@@ -21,7 +27,9 @@ from torchvision.models.inception import inception_v3
 
 
 # Module that wraps the inception network to enable use with dataparallel and
-# returning pool features and logits.
+# returning pool features and logits. If the net has been cast to half
+# precision, inputs are cast to match after normalization, and the pool and
+# logits are returned in float32.
 class WrapInception(nn.Module):
   def __init__(self, net):
     super(WrapInception,self).__init__()
@@ -30,13 +38,40 @@ class WrapInception(nn.Module):
                   requires_grad=False)
     self.std = P(torch.tensor([0.229, 0.224, 0.225]).view(1, -1, 1, 1),
                  requires_grad=False)
+    # Upsampling outputs, reused by batches of the same shape, per device
+    # and per thread, so that DataParallel's replicas (which share this
+    # module's attributes, each in its own thread) never write into the same
+    # output; prepare_inception_metrics clears these after each evaluation
+    self.clear_upsample_buffers()
+
+  def clear_upsample_buffers(self):
+    self.upsample_buffers = threading.local()
+
+  # Bilinearly upsample x to 299 x 299, into the last batch's output if it
+  # has the same shape, rather than allocating a new output every batch
+  def upsample(self, x):
+    memory_format = (torch.channels_last
+                     if x.is_contiguous(memory_format=torch.channels_last)
+                     and not x.is_contiguous() else torch.contiguous_format)
+    if not hasattr(self.upsample_buffers, 'outputs'):
+      self.upsample_buffers.outputs = {}
+    out = self.upsample_buffers.outputs.get(x.device)
+    if (out is None or out.shape[:2] != x.shape[:2] or out.dtype != x.dtype
+        or not out.is_contiguous(memory_format=memory_format)):
+      out = torch.empty(x.shape[0], x.shape[1], 299, 299, dtype=x.dtype,
+                        device=x.device, memory_format=memory_format)
+      self.upsample_buffers.outputs[x.device] = out
+    return torch.ops.aten.upsample_bilinear2d.out(x, [299, 299], True,
+                                                  None, None, out=out)
+
   def forward(self, x):
     # Normalize x
     x = (x + 1.) / 2.0
     x = (x - self.mean) / self.std
+    x = x.to(self.net.fc.weight.dtype)
     # Upsample if necessary
     if x.shape[2] != 299 or x.shape[3] != 299:
-      x = F.interpolate(x, size=(299, 299), mode='bilinear', align_corners=True)
+      x = self.upsample(x)
     # 299 x 299 x 3
     x = self.net.Conv2d_1a_3x3(x)
     # 149 x 149 x 32
@@ -79,7 +114,7 @@ class WrapInception(nn.Module):
     # 1 x 1 x 2048
     logits = self.net.fc(F.dropout(pool, training=False).view(pool.size(0), -1))
     # 1000 (num_classes)
-    return pool, logits
+    return pool.float(), logits.float()
 
 
 # A pytorch implementation of cov, from Modar M. Alfadly
@@ -183,10 +218,11 @@ def numpy_calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
 
   # Numerical error might give slight imaginary component
   if np.iscomplexobj(covmean):
-    print('wat')
+    m = np.max(np.abs(covmean.imag))
     if not np.allclose(np.diagonal(covmean).imag, 0, atol=1e-3):
-      m = np.max(np.abs(covmean.imag))
       raise ValueError('Imaginary component {}'.format(m))
+    print('Warning: discarding an imaginary component of up to %g in the '
+          'FID matrix sqrt' % m)
     covmean = covmean.real  
 
   tr_covmean = np.trace(covmean) 
@@ -229,6 +265,58 @@ def torch_calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
   return out
 
 
+# Square root of a symmetric PSD matrix via its eigendecomposition. Slightly
+# negative eigenvalues from rounding are clamped to 0.
+def sqrtm_psd(sigma):
+  eigvals, eigvecs = torch.linalg.eigh(sigma)
+  return (eigvecs * eigvals.clamp(min=0).sqrt()).mm(eigvecs.t())
+
+
+def eigh_calculate_frechet_distance(mu1, sigma1, mu2, sigma2, sqrt_sigma2=None,
+                                    return_error=False):
+  """Exact Frechet Distance via a symmetric eigendecomposition.
+  tr(sqrt(C_1*C_2)) is the sum of the square roots of the eigenvalues of
+  sqrt(C_2)*C_1*sqrt(C_2), which is symmetric PSD, so one eigh call in
+  float64 gives it without Newton-Schulz iterations or complex arithmetic.
+  Params:
+  -- mu1, sigma1: Torch tensors with the mean and covariance of the
+                  activations for generated samples.
+  -- mu2, sigma2: Torch tensors with the mean and covariance of the
+                  activations for the data.
+  -- sqrt_sigma2: sqrtm_psd(sigma2), if already computed. As the data's
+                  moments are fixed for a run, this can be cached.
+  -- return_error: Also return a bound on the error from the eigensolver.
+  Returns:
+  --   : The Frechet Distance, and optionally its error bound.
+  """
+  assert mu1.shape == mu2.shape, \
+    'Training and test mean vectors have different lengths'
+  assert sigma1.shape == sigma2.shape, \
+    'Training and test covariances have different dimensions'
+
+  mu1, sigma1 = mu1.double(), sigma1.double()
+  mu2, sigma2 = mu2.double(), sigma2.double()
+  if sqrt_sigma2 is None:
+    sqrt_sigma2 = sqrtm_psd(sigma2)
+  sqrt_sigma2 = sqrt_sigma2.double()
+  M = sqrt_sigma2.mm(sigma1).mm(sqrt_sigma2)
+  eigvals = torch.linalg.eigvalsh((M + M.t()) / 2)
+  tr_covmean = eigvals.clamp(min=0).sqrt().sum()
+  diff = mu1 - mu2
+  out = float(diff.dot(diff) + torch.trace(sigma1) + torch.trace(sigma2)
+              - 2 * tr_covmean)
+  if not return_error:
+    return out
+  # eigh is backward stable, so each eigenvalue is off by at most about
+  # delta = d * eps * ||M||; bound the resulting error in each sqrt.
+  delta = (M.shape[0] * torch.finfo(torch.float64).eps
+           * eigvals.abs().max())
+  roots = eigvals.clamp(min=0).sqrt()
+  error = 2 * torch.min(delta.sqrt().expand_as(roots),
+                        delta / (2 * roots.clamp(min=1e-300))).sum()
+  return out, float(error)
+
+
 # Calculate Inception Score mean + std given softmax'd logits and number of splits
 def calculate_inception_score(pred, num_splits=10):
   scores = []
@@ -245,64 +333,615 @@ def calculate_inception_score(pred, num_splits=10):
 # Inception Accuracy the labels of the generated class will be needed)
 def accumulate_inception_activations(sample, net, num_inception_images=50000):
   pool, logits, labels = [], [], []
-  while (torch.cat(logits, 0).shape[0] if len(logits) else 0) < num_inception_images:
+  num_images = 0
+  while num_images < num_inception_images:
     with torch.no_grad():
       images, labels_val = sample()
       pool_val, logits_val = net(images.float())
       pool += [pool_val]
       logits += [F.softmax(logits_val, 1)]
       labels += [labels_val]
+      num_images += logits_val.shape[0]
   return torch.cat(pool, 0), torch.cat(logits, 0), torch.cat(labels, 0)
 
 
-# Load and wrap the Inception model
-def load_inception_net(parallel=False):
+# Streaming Inception statistics, which avoid keeping every pool and logit
+# vector around. For FID, this keeps a running sum and sum of outer products
+# of the pool features in float64; for IS, it keeps the sums of the softmax'd
+# logits and of their p * log(p) in each split. Memory is O(d^2) no matter
+# how many images are used. As in calculate_inception_score, each split has
+# num_images // num_splits images and any remainder is left out of the IS,
+# so num_images (the total number of images to be added) must be set
+# before the first update. Stats for consecutive shards of the images can be
+# gathered separately, each with the offset of its shard's first image, then
+# merged; they can also be saved and loaded to resume. The pool features
+# themselves are kept (in float32) for the images marked in keep, a bool
+# tensor over all num_images, or for all of them if keep is True.
+class InceptionStats(object):
+  def __init__(self, num_splits=10, num_images=None, offset=0, keep=None):
+    self.num_splits = num_splits
+    self.num_images = num_images
+    self.offset = offset
+    self.keep = keep
+    self.features = []
+    self.n = 0
+
+  def update(self, pool, probs):
+    if self.keep is True:
+      self.features.append(pool.float())
+    elif self.keep is not None:
+      start = self.offset + self.n
+      self.features.append(
+        pool[self.keep[start:start + pool.shape[0]].to(pool.device)].float())
+    pool, probs = pool.double(), probs.double()
+    if not self.n:
+      if self.num_images is None:
+        raise ValueError('InceptionStats needs num_images before the first update')
+      self.split_size = self.num_images // self.num_splits
+      self.pool_sum = torch.zeros(pool.shape[1], dtype=torch.float64,
+                                  device=pool.device)
+      self.pool_outer = torch.zeros(pool.shape[1], pool.shape[1],
+                                    dtype=torch.float64, device=pool.device)
+      self.split_probs = torch.zeros(self.num_splits, probs.shape[1],
+                                     dtype=torch.float64, device=probs.device)
+      self.split_plogp = torch.zeros(self.num_splits, dtype=torch.float64,
+                                     device=probs.device)
+    self.pool_sum += pool.sum(0)
+    self.pool_outer.addmm_(pool.t(), pool)
+    # Add each image's probs into its split
+    split = (torch.arange(probs.shape[0], device=probs.device)
+             + self.offset + self.n) // max(self.split_size, 1)
+    keep = split < self.num_splits
+    self.split_probs.index_add_(0, split[keep], probs[keep])
+    self.split_plogp.index_add_(0, split[keep],
+                                torch.xlogy(probs, probs).sum(1)[keep])
+    self.n += pool.shape[0]
+
+  # Add in the stats of another shard of the same images
+  def merge(self, other):
+    if (other.num_images, other.num_splits) != (self.num_images, self.num_splits):
+      raise ValueError('Can only merge InceptionStats of shards of the same images')
+    if not other.n:
+      return
+    if not self.n:
+      self.split_size = other.split_size
+      self.pool_sum, self.pool_outer = other.pool_sum.clone(), other.pool_outer.clone()
+      self.split_probs, self.split_plogp = other.split_probs.clone(), other.split_plogp.clone()
+    else:
+      self.pool_sum += other.pool_sum.to(self.pool_sum.device)
+      self.pool_outer += other.pool_outer.to(self.pool_outer.device)
+      self.split_probs += other.split_probs.to(self.split_probs.device)
+      self.split_plogp += other.split_plogp.to(self.split_plogp.device)
+    self.features += other.features
+    self.n += other.n
+
+  def state_dict(self):
+    state = {'num_splits': self.num_splits, 'num_images': self.num_images,
+             'offset': self.offset, 'n': self.n,
+             'features': [torch.cat(self.features)] if self.features else []}
+    if self.n:
+      state.update({key: getattr(self, key) for key in
+                    ['split_size', 'pool_sum', 'pool_outer', 'split_probs',
+                     'split_plogp']})
+    return state
+
+  def load_state_dict(self, state):
+    for key in state:
+      setattr(self, key, state[key])
+
+  # Mean and covariance of the pool features
+  def moments(self):
+    mu = self.pool_sum / self.n
+    sigma = (self.pool_outer - self.n * torch.outer(mu, mu)) / (self.n - 1)
+    return mu, sigma
+
+  # The mean and std over the splits of exp(E[KL(p(y|x) || p(y))])
+  def inception_score(self):
+    p_y = self.split_probs / self.split_size
+    kl = self.split_plogp / self.split_size - torch.xlogy(p_y, p_y).sum(1)
+    scores = torch.exp(kl).cpu().numpy()
+    return np.mean(scores), np.std(scores)
+
+
+# Iterate over the images from enough calls to sample() to make up
+# num_images, in batches of batch_size (by default, the sampler's own batch
+# size). The first batch is sampled up front to find the sampler's batch size,
+# so num_images is rounded up to whole sampler batches. If pipeline, the next
+# sampler batch is produced while the current one is being consumed: on GPU
+# by sampling on a side stream, and on CPU in a producer thread.
+class SamplePipeline(object):
+  def __init__(self, sample, num_images, batch_size=0, pipeline=False):
+    self.sample = sample
+    with torch.no_grad():
+      self.first = sample()[0]
+    sample_batch_size = self.first.shape[0]
+    self.num_batches = int(math.ceil(num_images / sample_batch_size))
+    self.num_images = self.num_batches * sample_batch_size
+    self.batch_size = batch_size if batch_size > 0 else sample_batch_size
+    self.pipeline = pipeline
+
+  # Yield the sampler's batches
+  def produce(self):
+    yield self.first
+    if not self.pipeline:
+      for _ in range(self.num_batches - 1):
+        with torch.no_grad():
+          yield self.sample()[0]
+    elif self.first.is_cuda:
+      for images in self.produce_cuda():
+        yield images
+    else:
+      for images in self.produce_threaded():
+        yield images
+
+  def produce_cuda(self):
+    current = torch.cuda.current_stream()
+    stream = torch.cuda.Stream()
+    # Let the side stream see everything queued up before sampling started
+    stream.wait_stream(current)
+    def launch():
+      with torch.no_grad(), torch.cuda.stream(stream):
+        images = self.sample()[0]
+      return images, stream.record_event()
+    next_batch = launch() if self.num_batches > 1 else None
+    for index in range(1, self.num_batches):
+      images, event = next_batch
+      current.wait_event(event)
+      # Don't let the allocator reuse images until the main stream is done
+      images.record_stream(current)
+      next_batch = launch() if index + 1 < self.num_batches else None
+      yield images
+
+  def produce_threaded(self):
+    batches = queue.Queue(maxsize=1)
+    def produce():
+      try:
+        with torch.no_grad():
+          for _ in range(self.num_batches - 1):
+            batches.put(self.sample()[0])
+      except Exception as e:
+        batches.put(e)
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    for _ in range(self.num_batches - 1):
+      images = batches.get()
+      if isinstance(images, Exception):
+        raise images
+      yield images
+    thread.join()
+
+  def __len__(self):
+    return int(math.ceil(self.num_images / self.batch_size))
+
+  # Rebatch the sampler's batches into batches of batch_size
+  def __iter__(self):
+    pending, size = [], 0
+    for images in self.produce():
+      pending.append(images)
+      size += images.shape[0]
+      while size >= self.batch_size:
+        images = torch.cat(pending, 0) if len(pending) > 1 else pending[0]
+        pending, size = [images[self.batch_size:]], size - self.batch_size
+        yield images[:self.batch_size]
+    if size:
+      yield torch.cat(pending, 0)
+
+
+# Run the sampler and the net until they have seen num_inception_images images
+# and return their InceptionStats. As the sampler returns whole batches, the
+# IS splits are sized for the number of sampler batches needed. Inception
+# runs in batches of batch_size, and optionally pipelined with sampling.
+# If given, callback(stats) is called after every batch. If keep_features,
+# the pool features are kept in the stats too.
+def accumulate_inception_stats(sample, net, num_inception_images=50000,
+                               num_splits=10, batch_size=0, pipeline=False,
+                               callback=None, keep_features=False):
+  batches = SamplePipeline(sample, num_inception_images, batch_size, pipeline)
+  stats = InceptionStats(num_splits, batches.num_images,
+                         keep=True if keep_features else None)
+  for images in batches:
+    with torch.no_grad():
+      pool_val, logits_val = net(images.float())
+      stats.update(pool_val, F.softmax(logits_val, 1))
+    if callback is not None:
+      callback(stats)
+  return stats
+
+
+# Like accumulate_inception_stats, for the images at each of several points,
+# e.g. along a truncation curve. sample(points) returns a list of batches of
+# images, one for each of the given points, and is called until each point
+# has num_images[point] images; once a point has enough it is no longer
+# sampled. The points' batches run through the net together, batch_size
+# images at a time. Returns the InceptionStats of each point.
+def accumulate_curve_stats(sample, net, num_images, num_splits=10,
+                           batch_size=0):
+  with torch.no_grad():
+    images = sample(list(range(len(num_images))))[0]
+  sample_batch_size = images[0].shape[0]
+  num_batches = [int(math.ceil(n / sample_batch_size)) for n in num_images]
+  stats = [InceptionStats(num_splits, n * sample_batch_size)
+           for n in num_batches]
+  batch_size = batch_size if batch_size > 0 else sample_batch_size
+  for index in range(max(num_batches)):
+    points = [point for point, n in enumerate(num_batches) if index < n]
+    with torch.no_grad():
+      if index:
+        images = sample(points)[0]
+      outputs = [net(chunk.float())
+                 for chunk in torch.cat(images, 0).split(batch_size)]
+      pool = torch.cat([item[0] for item in outputs], 0)
+      probs = F.softmax(torch.cat([item[1] for item in outputs], 0), 1)
+    for point, point_pool, point_probs in zip(points,
+                                              pool.split(sample_batch_size),
+                                              probs.split(sample_batch_size)):
+      stats[point].update(point_pool, point_probs)
+  return stats
+
+
+# Extrapolate FID to an infinite number of samples (FID_inf, from Chong and
+# Forsyth, "Effectively Unbiased FID and Inception Score and where to find
+# them"). FID's bias is linear in 1/N, so fit FID against 1/N by least
+# squares over several sample sizes and take the intercept.
+def extrapolate_fid(sizes, FIDs):
+  slope, intercept = np.polyfit(1. / np.asarray(sizes, dtype=np.float64),
+                                np.asarray(FIDs, dtype=np.float64), 1)
+  return float(intercept)
+
+
+# Squared euclidean distances between the rows of x and the rows of y
+def squared_distances(x, y):
+  return (x.pow(2).sum(1, keepdim=True) - 2 * x.mm(y.t())
+          + y.pow(2).sum(1)).clamp(min=0)
+
+
+# The squared distance from each row of features to its k-th nearest
+# neighbour among the other rows. Distances are computed block_size rows at
+# a time, so memory stays at block_size x N rather than N x N.
+def knn_radii(features, k, block_size=1024):
+  radii = []
+  for block in features.split(block_size):
+    # Each row's nearest neighbour is itself, at distance 0
+    radii.append(squared_distances(block, features).kthvalue(k + 1, 1)[0])
+  return torch.cat(radii)
+
+
+# Improved precision and recall (Kynkaanniemi et al., "Improved Precision and
+# Recall Metric for Assessing Generative Models") and density and coverage
+# (Naeem et al., "Reliable Fidelity and Diversity Metrics for Generative
+# Models"), from the real and fake features and their squared k-NN radii.
+# A single pass over blocks of fake rows gets all four, so memory stays at
+# block_size x N_real.
+def calculate_knn_metrics(real, fake, real_radii, fake_radii, k,
+                          block_size=1024):
+  # Whether each fake is in any real's k-NN ball, and how many it is in
+  in_real, num_in_real = [], []
+  # Whether each real is in any fake's k-NN ball, and its nearest fake
+  in_fake = torch.zeros(real.shape[0], dtype=torch.bool, device=real.device)
+  nearest_fake = torch.full((real.shape[0],), float('inf'), device=real.device)
+  for block, block_radii in zip(fake.split(block_size),
+                                fake_radii.split(block_size)):
+    distances = squared_distances(block, real)
+    inside = distances <= real_radii
+    in_real.append(inside.any(1))
+    num_in_real.append(inside.sum(1))
+    in_fake |= (distances <= block_radii[:, None]).any(0)
+    nearest_fake = torch.min(nearest_fake, distances.min(0)[0])
+  return {'precision': float(torch.cat(in_real).double().mean()),
+          'recall': float(in_fake.double().mean()),
+          'density': float(torch.cat(num_in_real).double().sum()
+                           / (k * fake.shape[0])),
+          'coverage': float((nearest_fake <= real_radii).double().mean())}
+
+
+# Kernel Inception Distance (Binkowski et al., "Demystifying MMD GANs"): the
+# unbiased estimate of the squared MMD between the real and fake features
+# with the kernel (x.y / d + 1) ** 3, on num_subsets random subsets of
+# subset_size of each. Returns its mean and std over the subsets.
+def calculate_kid(real, fake, num_subsets=100, subset_size=1000, seed=0):
+  generator = torch.Generator().manual_seed(seed)
+  m = min(subset_size, real.shape[0], fake.shape[0])
+  kernel = lambda x, y: (x.mm(y.t()) / x.shape[1] + 1) ** 3
+  mmds = []
+  for _ in range(num_subsets):
+    x = real[torch.randperm(real.shape[0], generator=generator)[:m].to(real.device)].double()
+    y = fake[torch.randperm(fake.shape[0], generator=generator)[:m].to(fake.device)].double()
+    k_xx, k_yy = kernel(x, x), kernel(y, y)
+    mmds.append((k_xx.sum() - k_xx.trace() + k_yy.sum() - k_yy.trace())
+                / (m * (m - 1)) - 2 * kernel(x, y).mean())
+  mmds = torch.stack(mmds).cpu().numpy()
+  return float(np.mean(mmds)), float(np.std(mmds))
+
+
+# Load and wrap the Inception model, optionally in half precision
+def load_inception_net(parallel=False, channels_last=False, fp16=False,
+                       device='cuda'):
   inception_model = inception_v3(pretrained=True, transform_input=False)
-  inception_model = WrapInception(inception_model.eval()).cuda()
+  inception_model = WrapInception(inception_model.eval()).to(device)
+  if channels_last:
+    inception_model = inception_model.to(memory_format=torch.channels_last)
+  if fp16:
+    print('Casting Inception to float16...')
+    inception_model = inception_model.half()
   if parallel:
     print('Parallelizing Inception module...')
     inception_model = nn.DataParallel(inception_model)
   return inception_model
 
 
+# Find the largest power-of-2 batch size, up to limit, that Inception can run
+# with on GPU without running out of memory, probing on the net's device
+# with inputs as it gets them: float32 samples at the given resolution, in
+# channels_last if the net is. Returns 0 (i.e. use the sampler's batch size)
+# if the net is not on GPU.
+def find_inception_batch_size(net, resolution=299, limit=1024):
+  wrapped = getattr(net, 'module', net)
+  weight = wrapped.net.Conv2d_1a_3x3.conv.weight
+  if weight.device.type != 'cuda':
+    return 0
+  memory_format = (torch.channels_last
+                   if weight.is_contiguous(memory_format=torch.channels_last)
+                   else torch.contiguous_format)
+  batch_size = limit
+  while batch_size > 1:
+    try:
+      with torch.no_grad():
+        net(torch.zeros(batch_size, 3, resolution, resolution,
+                        device=weight.device, memory_format=memory_format))
+      break
+    except torch.cuda.OutOfMemoryError:
+      batch_size //= 2
+    finally:
+      # Don't keep the probe's upsampling output around
+      wrapped.clear_upsample_buffers()
+      torch.cuda.empty_cache()
+  return batch_size
+
+
+# A store of datasets' Inception moments, keyed by a fingerprint of the
+# dataset (see utils.dataset_fingerprint). Each entry is a directory of .npy
+# files with mu and sigma, and sigma's eigendecomposition and square root,
+# which are computed once when the entry is saved. Entries are memory-mapped
+# when loaded, so that FID never has to re-read or refactor sigma. An entry
+# can also hold a sample of the data's pool features, for the metrics that
+# need them, and other arrays computed from those, e.g. their k-NN radii.
+class MomentsStore(object):
+  def __init__(self, root='moments'):
+    self.root = root
+
+  def path(self, dataset, fingerprint):
+    return '%s/%s_%s' % (self.root, dataset, fingerprint)
+
+  # Save mu and sigma (numpy arrays) and their factorizations. The entry is
+  # written to a temporary directory and renamed, so it is never seen half
+  # written.
+  def save(self, dataset, fingerprint, mu, sigma, features=None):
+    path = self.path(dataset, fingerprint)
+    eigvals, eigvecs = torch.linalg.eigh(torch.tensor(sigma, dtype=torch.float64))
+    sqrt_sigma = (eigvecs * eigvals.clamp(min=0).sqrt()).mm(eigvecs.t())
+    arrays = {'mu': np.asarray(mu, dtype=np.float64),
+              'sigma': np.asarray(sigma, dtype=np.float64),
+              'sqrt_sigma': sqrt_sigma.numpy(), 'eigvals': eigvals.numpy(),
+              'eigvecs': eigvecs.numpy()}
+    if features is not None:
+      arrays['features'] = np.asarray(features, dtype=np.float32)
+    os.makedirs(path + '.tmp', exist_ok=True)
+    for key in arrays:
+      np.save('%s.tmp/%s.npy' % (path, key), arrays[key])
+    if os.path.isdir(path):
+      shutil.rmtree(path)
+    os.replace(path + '.tmp', path)
+    return path
+
+  # The entry's arrays, memory-mapped, or None if there is no such entry
+  def load(self, dataset, fingerprint):
+    path = self.path(dataset, fingerprint)
+    if fingerprint is None or not os.path.isdir(path):
+      return None
+    return {os.path.splitext(fname)[0]: np.load('%s/%s' % (path, fname),
+                                               mmap_mode='r')
+            for fname in os.listdir(path) if fname.endswith('.npy')}
+
+  # Add an array to an existing entry, again via a temporary file
+  def add(self, dataset, fingerprint, key, array):
+    fname = '%s/%s.npy' % (self.path(dataset, fingerprint), key)
+    with open(fname + '.tmp', 'wb') as f:
+      np.save(f, array)
+    os.replace(fname + '.tmp', fname)
+
+
+# The name of a dataset's moments file from calculate_inception_moments; the
+# hdf5 and image folder versions of a dataset share one
+def moments_filename(dataset):
+  if dataset.endswith('_hdf5'):
+    dataset = dataset[:-len('_hdf5')]
+  return dataset + '_inception_moments.npz'
+
+
+# Get a dataset's moments from the store, or failing that from its moments
+# file, which is then added to the store if the dataset's fingerprint is known
+def load_data_moments(dataset, fingerprint=None, moments_root='moments'):
+  store = MomentsStore(moments_root)
+  moments = store.load(dataset, fingerprint)
+  if moments is not None:
+    print('Loading Inception moments from %s...' % store.path(dataset, fingerprint))
+    return moments
+  if not os.path.exists(moments_filename(dataset)):
+    raise ValueError('No Inception moments for %s in %s or %s; run '
+                     'calculate_inception_moments.py first'
+                     % (dataset, moments_root, moments_filename(dataset)))
+  print('Loading Inception moments from %s...' % moments_filename(dataset))
+  with np.load(moments_filename(dataset)) as f:
+    mu, sigma = f['mu'], f['sigma']
+  if fingerprint is None:
+    return {'mu': mu, 'sigma': sigma}
+  print('Adding them to %s...' % store.save(dataset, fingerprint, mu, sigma))
+  return store.load(dataset, fingerprint)
+
+
 # This produces a function which takes in an iterator which returns a set number of samples
 # and iterates until it accumulates config['num_inception_images'] images.
 # The iterator can return samples with a different batch size than used in
-# training, using the setting confg['inception_batchsize']
-def prepare_inception_metrics(dataset, parallel, no_fid=False):
+# training; Inception runs with batch_size (config['inception_batch_size'])
+# if it is set, or the largest batch size that fits if it is negative,
+# optionally pipelined with sampling and in half precision. resolution is
+# that of the samples, for finding the batch size. The data's moments come
+# from the store in moments_root if the dataset's fingerprint is given (see
+# load_data_moments). Any of KID, PR (precision and recall) and DC (density
+# and coverage), joined by underscores in extra_metrics, are also available
+# from the same samples; these compare with the sample of the data's pool
+# features in the store, using its k-NN radii for PR and DC, which are
+# computed once and then stored with it.
+def prepare_inception_metrics(dataset, parallel, no_fid=False,
+                              channels_last=False, batch_size=0,
+                              pipeline=False, fid_backend='newton_schulz',
+                              fp16=False, resolution=299, device='cuda',
+                              fingerprint=None, moments_root='moments',
+                              extra_metrics='', knn_k=3, kid_subsets=100,
+                              kid_subset_size=1000):
   # Load metrics; this is intentionally not in a try-except loop so that
   # the script will crash here if it cannot find the Inception moments.
-  # By default, remove the "hdf5" from dataset
-  dataset = dataset.strip('_hdf5')
-  data_mu = np.load(dataset+'_inception_moments.npz')['mu']
-  data_sigma = np.load(dataset+'_inception_moments.npz')['sigma']
+  moments = load_data_moments(dataset, fingerprint, moments_root)
+  data_mu, data_sigma = np.asarray(moments['mu']), np.asarray(moments['sigma'])
+  if fid_backend not in ['eigh', 'newton_schulz', 'scipy']:
+    raise ValueError('Unknown FID backend %s' % fid_backend)
+  print('Using the %s FID backend...' % fid_backend)
+  extra_metrics = extra_metrics.split('_') if extra_metrics else []
+  for metric in extra_metrics:
+    if metric not in ['KID', 'PR', 'DC']:
+      raise ValueError('Unknown metric %s' % metric)
+  if extra_metrics and 'features' not in moments:
+    raise ValueError('Metrics %s need a sample of the data\'s pool features in the '
+                     'moments store; run calculate_inception_moments.py '
+                     'with --num_real_features' % ', '.join(extra_metrics))
+  radii_key = 'radii_k%d' % knn_k
+  if ('PR' in extra_metrics or 'DC' in extra_metrics) and radii_key not in moments:
+    print('Calculating the k-NN radii of the data features...')
+    moments[radii_key] = knn_radii(
+      torch.tensor(np.asarray(moments['features'])).to(device), knn_k).cpu().numpy()
+    MomentsStore(moments_root).add(dataset, fingerprint, radii_key,
+                                   moments[radii_key])
+  # The data moments (and, for eigh, sqrt(data_sigma)) and the data features
+  # and their radii as torch tensors, copied to each device once for the
+  # whole run
+  data_moments, data_features = {}, {}
   # Load network
-  net = load_inception_net(parallel)
+  net = load_inception_net(parallel, channels_last, fp16, device)
+  if batch_size < 0:
+    batch_size = find_inception_batch_size(net, resolution)
+    print('Using an Inception batch size of %d...' % batch_size)
+  # Get FID from the moments of the samples, with the chosen backend
+  def get_FID(mu, sigma, backend, prints):
+    if backend != 'scipy' and mu.device not in data_moments:
+      data_moments[mu.device] = [torch.tensor(data_mu).to(mu.device),
+                                 torch.tensor(data_sigma).to(mu.device)]
+      if backend == 'eigh':
+        data_moments[mu.device] += [
+          torch.tensor(np.asarray(moments['sqrt_sigma'])).to(mu.device)
+          if 'sqrt_sigma' in moments
+          else sqrtm_psd(data_moments[mu.device][1].double())]
+    if backend == 'eigh':
+      FID, FID_error = eigh_calculate_frechet_distance(
+        mu, sigma, *data_moments[mu.device], return_error=True)
+      if prints:
+        print('FID error from the eigensolver is at most %3.3e' % FID_error)
+    elif backend == 'newton_schulz':
+      FID = torch_calculate_frechet_distance(mu.float(), sigma.float(), *[item.float() for item in data_moments[mu.device]])
+      FID = float(FID.cpu().numpy())
+    else:
+      FID = numpy_calculate_frechet_distance(mu.cpu().numpy(), sigma.cpu().numpy(), data_mu, data_sigma)
+    return FID
+
+  # Get the extra metrics from the pool features of the samples
+  def get_extra_metrics(features, prints):
+    if features.device not in data_features:
+      data_features[features.device] = [
+        torch.tensor(np.asarray(moments[key])).to(features.device)
+        for key in ['features', radii_key] if key in moments]
+    real_features = data_features[features.device][0]
+    out = {}
+    if 'KID' in extra_metrics:
+      if prints:
+        print('Calculating KID...')
+      out['KID_mean'], out['KID_std'] = calculate_kid(
+        real_features, features, kid_subsets, kid_subset_size)
+    if 'PR' in extra_metrics or 'DC' in extra_metrics:
+      if prints:
+        print('Calculating k-NN metrics...')
+      knn_metrics = calculate_knn_metrics(
+        real_features, features, data_features[features.device][1],
+        knn_radii(features, knn_k), knn_k)
+      for metric, keys in [('PR', ['precision', 'recall']),
+                           ('DC', ['density', 'coverage'])]:
+        if metric in extra_metrics:
+          out.update({key: knn_metrics[key] for key in keys})
+    return out
+
+  # If num_FID_points > 1, FID is also computed on num_FID_points prefixes
+  # of the samples, evenly spaced from half of them to all of them, and the
+  # FID_inf extrapolated from those is returned as a fourth output. If
+  # return_extra, a dict of the extra metrics is returned after the others.
+  # If curve, sample and num_inception_images are as for
+  # accumulate_curve_stats, and a list of each point's IS mean and std and
+  # FID is returned.
   def get_inception_metrics(sample, num_inception_images, num_splits=10, 
-                            prints=True, use_torch=True):
+                            prints=True, use_torch=True, num_FID_points=0,
+                            return_extra=False, curve=False):
+    backend = fid_backend if use_torch else 'scipy'
+    if curve:
+      if prints:
+        print('Gathering activations for %d points...' % len(num_inception_images))
+      outputs = []
+      for stats in accumulate_curve_stats(sample, net, num_inception_images,
+                                          num_splits, batch_size):
+        IS_mean, IS_std = stats.inception_score()
+        FID = 9999.0 if no_fid else get_FID(*stats.moments(), backend, False)
+        outputs.append((IS_mean, IS_std, FID))
+      getattr(net, 'module', net).clear_upsample_buffers()
+      return outputs
+    sizes, FIDs = [], []
+    callback = None
+    if num_FID_points > 1 and not no_fid:
+      checkpoints = list(np.linspace(num_inception_images // 2,
+                                     num_inception_images,
+                                     num_FID_points)[:-1].astype(int))
+      def callback(stats):
+        if checkpoints and stats.n >= checkpoints[0]:
+          while checkpoints and stats.n >= checkpoints[0]:
+            checkpoints.pop(0)
+          sizes.append(stats.n)
+          FIDs.append(get_FID(*stats.moments(), backend, False))
     if prints:
       print('Gathering activations...')
-    pool, logits, labels = accumulate_inception_activations(sample, net, num_inception_images)
+    stats = accumulate_inception_stats(sample, net, num_inception_images,
+                                       num_splits, batch_size, pipeline,
+                                       callback,
+                                       return_extra and bool(extra_metrics))
+    # Free the upsampling output between evaluations rather than holding it
+    # through training
+    getattr(net, 'module', net).clear_upsample_buffers()
     if prints:  
       print('Calculating Inception Score...')
-    IS_mean, IS_std = calculate_inception_score(logits.cpu().numpy(), num_splits)
+    IS_mean, IS_std = stats.inception_score()
     if no_fid:
-      FID = 9999.0
+      FID = FID_inf = 9999.0
     else:
       if prints:
         print('Calculating means and covariances...')
-      if use_torch:
-        mu, sigma = torch.mean(pool, 0), torch_cov(pool, rowvar=False)
-      else:
-        mu, sigma = np.mean(pool.cpu().numpy(), axis=0), np.cov(pool.cpu().numpy(), rowvar=False)
+      mu, sigma = stats.moments()
       if prints:
         print('Covariances calculated, getting FID...')
-      if use_torch:
-        FID = torch_calculate_frechet_distance(mu, sigma, torch.tensor(data_mu).float().cuda(), torch.tensor(data_sigma).float().cuda())
-        FID = float(FID.cpu().numpy())
-      else:
-        FID = numpy_calculate_frechet_distance(mu.cpu().numpy(), sigma.cpu().numpy(), data_mu, data_sigma)
-    # Delete mu, sigma, pool, logits, and labels, just in case
-    del mu, sigma, pool, logits, labels
-    return IS_mean, IS_std, FID
+      FID = get_FID(mu, sigma, backend, prints)
+      sizes.append(stats.n)
+      FIDs.append(FID)
+      FID_inf = extrapolate_fid(sizes, FIDs) if len(sizes) > 1 else FID
+    outputs = [IS_mean, IS_std, FID]
+    if num_FID_points > 1:
+      outputs += [FID_inf]
+    if return_extra:
+      outputs += [get_extra_metrics(torch.cat(stats.features), prints)
+                  if stats.features else {}]
+    # Delete the stats, just in case
+    del stats
+    return tuple(outputs)
   return get_inception_metrics
\ No newline at end of file
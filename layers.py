@@ -1,6 +1,8 @@
 ''' Layers
     This file contains various layers for the BigGAN models.
 '''
+import collections
+import contextlib
 import numpy as np
 import torch
 import torch.nn as nn
@@ -8,10 +10,100 @@ from torch.nn import init
 import torch.optim as optim
 import torch.nn.functional as F
 from torch.nn import Parameter as P
+import torch.utils.checkpoint
 
 from sync_batchnorm import SynchronizedBatchNorm2d as SyncBN2d
 
 
+# Activation checkpointing. A function run under checkpoint() only keeps its
+# inputs for backward, and is re-run from them when its activations are
+# needed. The re-run must not repeat the first run's side effects, so while a
+# checkpointed function runs, stateful layers consult the active tape: on the
+# first run SN layers record the singular vectors they used, and on the
+# recompute they replay them (rather than running and writing back another
+# power iteration), while BN layers skip their running-stat updates.
+class Tape(object):
+  def __init__(self):
+    self.records = []
+    self.replaying = False
+    self.position = 0
+
+  def record(self, item):
+    self.records.append(item)
+
+  def replay(self):
+    item = self.records[self.position]
+    self.position += 1
+    return item
+
+_tape = None
+
+# Are we recomputing a checkpointed function?
+def replaying():
+  return _tape is not None and _tape.replaying
+
+def checkpoint(function, *args):
+  tape = Tape()
+  def run(*args):
+    global _tape
+    prev_tape, _tape = _tape, tape
+    tape.position = 0
+    try:
+      return function(*args)
+    finally:
+      _tape = prev_tape
+      tape.replaying = True
+  return torch.utils.checkpoint.checkpoint(run, *args, use_reentrant=False)
+
+
+# Deferred buffer updates. In training mode, SN layers write back their
+# singular vectors and values and BN layers their running stats on every
+# forward, so running a forward more than once per step changes the model's
+# state more than once. Inside a deferred_updates() context those writes are
+# collected instead, and applied together when the context exits (i.e. once per
+# optimizer step), so forwards don't change the state until then. Every SN
+# forward starts from the same u, and keeps the result of the last forward;
+# BN running stats are averaged over all forwards, as if their batches had
+# been one.
+class DeferredUpdates(object):
+  def __init__(self):
+    self.pending = collections.OrderedDict()
+
+  def write(self, buffer, value, average=False):
+    if id(buffer) not in self.pending:
+      self.pending[id(buffer)] = (buffer, [], average)
+    self.pending[id(buffer)][1].append(value.detach())
+
+  def commit(self):
+    with torch.no_grad():
+      for buffer, values, average in self.pending.values():
+        buffer.copy_(sum(values) / len(values) if average else values[-1])
+    self.pending.clear()
+
+_deferred = None
+
+@contextlib.contextmanager
+def deferred_updates(enabled=True):
+  global _deferred
+  if not enabled:
+    yield None
+    return
+  prev_deferred, _deferred = _deferred, DeferredUpdates()
+  try:
+    yield _deferred
+    _deferred.commit()
+  finally:
+    _deferred = prev_deferred
+
+# Write value into a buffer, now or when the deferred_updates() context exits
+def update_buffer(buffer, value, average=False):
+  if _deferred is not None:
+    _deferred.write(buffer, value, average)
+  else:
+    with torch.no_grad():
+      buffer.copy_(value)
+
+
 # Projection of x onto y
 def proj(x, y):
   return torch.mm(y, x.t()) * y / torch.mm(y, y.t())
@@ -85,17 +177,40 @@ class SN(object):
    
   # Compute the spectrally-normalized weight
   def W_(self):
-    W_mat = self.weight.view(self.weight.size(0), -1)
+    # Channels_last conv weights can't be viewed as a matrix directly, so
+    # permute them first; this only reorders the columns, which doesn't
+    # change the singular values.
+    if self.weight.dim() == 4 and self.weight.is_contiguous(memory_format=torch.channels_last):
+      W_mat = self.weight.permute(0, 2, 3, 1).reshape(self.weight.size(0), -1)
+    else:
+      W_mat = self.weight.view(self.weight.size(0), -1)
     if self.transpose:
       W_mat = W_mat.t()
+    # If recomputing under activation checkpointing, reuse the singular
+    # vectors from the first run, so that the singular values (and hence the
+    # weights) are the same and the buffers aren't updated twice
+    if replaying():
+      us, vs = _tape.replay()
+      svs = [torch.squeeze(torch.matmul(torch.matmul(v, W_mat.t()), u.t()))
+             for u, v in zip(us, vs)]
+      return self.weight / svs[0]
+    # If deferring buffer updates, iterate on copies of u and write them back
+    # when the updates are committed
+    deferred = self.training and _deferred is not None
+    u_ = [u.clone() for u in self.u] if deferred else self.u
     # Apply num_itrs power iterations
     for _ in range(self.num_itrs):
-      svs, us, vs = power_iteration(W_mat, self.u, update=self.training, eps=self.eps) 
+      svs, us, vs = power_iteration(W_mat, u_, update=self.training, eps=self.eps) 
+    if _tape is not None:
+      _tape.record((us, vs))
     # Update the svs
     if self.training:
       with torch.no_grad(): # Make sure to do this in a no_grad() context or you'll get memory leaks!
         for i, sv in enumerate(svs):
-          self.sv[i][:] = sv     
+          update_buffer(self.sv[i], sv)
+        if deferred:
+          for u_buffer, u in zip(self.u, u_):
+            update_buffer(u_buffer, u)
     return self.weight / svs[0]
 
 
@@ -164,10 +279,21 @@ class Attention(nn.Module):
     g = g.view(-1, self. ch // 2, x.shape[2] * x.shape[3] // 4)
     # Matmul and softmax to get attention maps
     beta = F.softmax(torch.bmm(theta.transpose(1, 2), phi), -1)
-    # Attention map times g path
-    o = self.o(torch.bmm(g, beta.transpose(1,2)).view(-1, self.ch // 2, x.shape[2], x.shape[3]))
+    # Attention map times g path. For channels_last inputs, compute the
+    # transposed product so the result is already channels_last.
+    if x.is_contiguous(memory_format=torch.channels_last):
+      o = torch.bmm(beta, g.transpose(1, 2)).transpose(1, 2)
+    else:
+      o = torch.bmm(g, beta.transpose(1,2))
+    o = self.o(o.view(-1, self.ch // 2, x.shape[2], x.shape[3]))
     return self.gamma * o + x
 
+  # Fold the spectral norms into the convs for inference
+  def fold(self):
+    self.theta, self.phi = fold_conv(self.theta), fold_conv(self.phi)
+    self.g, self.o = fold_conv(self.g), fold_conv(self.o)
+    return self
+
 
 # Fused batchnorm op
 def fused_bn(x, mean, var, gain=None, bias=None, eps=1e-5):
@@ -187,20 +313,12 @@ def fused_bn(x, mean, var, gain=None, bias=None, eps=1e-5):
 
 
 # Manual BN
-# Calculate means and variances using mean-of-squares minus mean-squared
+# Calculate means and variances in a single pass with torch.var_mean, which
+# uses Welford's algorithm with fp32 accumulators. Unlike mean-of-squares minus
+# mean-squared, this doesn't suffer from cancellation in fp16, and doesn't
+# need an fp32 copy of x (or of x ** 2) when x is half precision.
 def manual_bn(x, gain=None, bias=None, return_mean_var=False, eps=1e-5):
-  # Cast x to float32 if necessary
-  float_x = x.float()
-  # Calculate expected value of x (m) and expected value of x**2 (m2)  
-  # Mean of x
-  m = torch.mean(float_x, [0, 2, 3], keepdim=True)
-  # Mean of x squared
-  m2 = torch.mean(float_x ** 2, [0, 2, 3], keepdim=True)
-  # Calculate variance as mean of squared minus mean squared.
-  var = (m2 - m **2)
-  # Cast back to float 16 if necessary
-  var = var.type(x.type())
-  m = m.type(x.type())
+  var, m = torch.var_mean(x, [0, 2, 3], unbiased=False, keepdim=True)
   # Return mean and variance for updating stored mean/var if requested  
   if return_mean_var:
     return fused_bn(x, m, var, gain, bias, eps), m.squeeze(), var.squeeze()
@@ -234,15 +352,22 @@ class myBN(nn.Module):
   def forward(self, x, gain, bias):
     if self.training:
       out, mean, var = manual_bn(x, gain, bias, return_mean_var=True, eps=self.eps)
+      # Stats were already updated on the first run of a checkpointed block
+      if replaying():
+        pass
       # If accumulating standing stats, increment them
-      if self.accumulate_standing:
+      elif self.accumulate_standing:
         self.stored_mean[:] = self.stored_mean + mean.data
         self.stored_var[:] = self.stored_var + var.data
         self.accumulation_counter += 1.0
       # If not accumulating standing stats, take running averages
       else:
-        self.stored_mean[:] = self.stored_mean * (1 - self.momentum) + mean * self.momentum
-        self.stored_var[:] = self.stored_var * (1 - self.momentum) + var * self.momentum
+        update_buffer(self.stored_mean,
+                      self.stored_mean * (1 - self.momentum) + mean * self.momentum,
+                      average=True)
+        update_buffer(self.stored_var,
+                      self.stored_var * (1 - self.momentum) + var * self.momentum,
+                      average=True)
       return out
     # If not in training mode, use the stored statistics
     else:         
@@ -270,6 +395,22 @@ def groupnorm(x, norm_style):
   return F.group_norm(x, groups)
 
 
+# Running stats to hand to F.batch_norm / F.instance_norm, which updates them
+# in place in training mode. When recomputing a checkpointed forward, or
+# deferring buffer updates, these are copies (rather than None, so that
+# recomputation saves the same tensors for backward as the first run did).
+def running_stats(module):
+  if module.training and (replaying() or _deferred is not None):
+    return module.stored_mean.clone(), module.stored_var.clone()
+  return module.stored_mean, module.stored_var
+
+# Hand the copies' updates over to the deferred updates, except on recompute
+def update_running_stats(module, mean, var):
+  if module.training and _deferred is not None and not replaying():
+    update_buffer(module.stored_mean, mean, average=True)
+    update_buffer(module.stored_var, var, average=True)
+
+
 # Class-conditional bn
 # output size is the number of channels, input size is for the linear layers
 # Andy's Note: this class feels messy but I'm not really sure how to clean it up
@@ -313,11 +454,15 @@ class ccbn(nn.Module):
     # else:
     else:
       if self.norm_style == 'bn':
-        out = F.batch_norm(x, self.stored_mean, self.stored_var, None, None,
+        mean, var = running_stats(self)
+        out = F.batch_norm(x, mean, var, None, None,
                           self.training, 0.1, self.eps)
+        update_running_stats(self, mean, var)
       elif self.norm_style == 'in':
-        out = F.instance_norm(x, self.stored_mean, self.stored_var, None, None,
+        mean, var = running_stats(self)
+        out = F.instance_norm(x, mean, var, None, None,
                           self.training, 0.1, self.eps)
+        update_running_stats(self, mean, var)
       elif self.norm_style == 'gn':
         out = groupnorm(x, self.normstyle)
       elif self.norm_style == 'nonorm':
@@ -362,10 +507,199 @@ class bn(nn.Module):
       bias = self.bias.view(1,-1,1,1)
       return self.bn(x, gain=gain, bias=bias)
     else:
-      return F.batch_norm(x, self.stored_mean, self.stored_var, self.gain,
-                          self.bias, self.training, self.momentum, self.eps)
+      mean, var = running_stats(self)
+      out = F.batch_norm(x, mean, var, self.gain, self.bias, self.training,
+                         self.momentum, self.eps)
+      update_running_stats(self, mean, var)
+      return out
+
+
+# Class-conditional affine, as used by folded (inference-only) Generators.
+# A single linear or embedding layer produces the per-sample scale and shift
+# (with any BN statistics already folded in), which are applied in one
+# multiply-add, followed by the activation.
+class ccaffine(nn.Module):
+  def __init__(self, output_size, linear, activation=None):
+    super(ccaffine, self).__init__()
+    self.output_size = output_size
+    self.linear = linear
+    self.activation = activation
+
+  def forward(self, x, y):
+    scale, shift = torch.split(self.linear(y).view(y.size(0), -1, 1, 1),
+                               self.output_size, 1)
+    out = torch.addcmul(shift, x, scale)
+    return self.activation(out) if self.activation is not None else out
+  def extra_repr(self):
+    return 'out: {output_size}'.format(**self.__dict__)
+
+
+# Non-class-conditional counterpart of ccaffine, with a fixed scale and shift
+class affine(nn.Module):
+  def __init__(self, scale, shift, activation=None):
+    super(affine, self).__init__()
+    self.register_buffer('scale', scale.view(1, -1, 1, 1))
+    self.register_buffer('shift', shift.view(1, -1, 1, 1))
+    self.activation = activation
+
+  def forward(self, x):
+    out = torch.addcmul(self.shift, x, self.scale)
+    return self.activation(out) if self.activation is not None else out
+
+
+# Folding utilities for building inference-only Generators.
+# In eval mode, every ccbn/bn normalizes with fixed statistics and every SN
+# layer divides by a fixed singular value, so both can be baked into plain
+# weights ahead of time.
+
+# Get the weight a (possibly spectrally-normalized) layer applies. Note that
+# for SN layers in training mode, this also runs the power iteration.
+def effective_weight(module):
+  return module.W_() if isinstance(module, SN) else module.weight
+
+
+# Get the mean and inverse std a ccbn or bn normalizes with in eval mode
+def eval_bn_stats(norm):
+  if norm.cross_replica:
+    raise ValueError('Cannot fold cross-replica batchnorm')
+  if norm.mybn:
+    mean, var, eps = norm.bn.stored_mean, norm.bn.stored_var, norm.bn.eps
+    # If using standing stats, divide them by the accumulation counter
+    if norm.bn.accumulate_standing:
+      mean = mean / norm.bn.accumulation_counter
+      var = var / norm.bn.accumulation_counter
+  elif getattr(norm, 'norm_style', 'bn') in ['bn', 'in']:
+    mean, var, eps = norm.stored_mean, norm.stored_var, norm.eps
+  elif norm.norm_style == 'nonorm':
+    mean = torch.zeros(norm.output_size, device=norm.gain.weight.device)
+    return mean, torch.ones_like(mean)
+  else:
+    raise ValueError('Cannot fold norm_style %s' % norm.norm_style)
+  return mean.float(), torch.rsqrt(var.float() + eps)
+
+
+# Use an in-place ReLU where possible, as folded activations always act on
+# a freshly allocated output.
+def fused_activation(activation):
+  return nn.ReLU(inplace=True) if isinstance(activation, nn.ReLU) else activation
+
+
+# Fold a conv's spectral norm and, optionally, the eval-mode normalization of
+# the ccbn or bn which directly follows it into a plain nn.Conv2d.
+def fold_conv(conv, norm=None):
+  weight = effective_weight(conv).float()
+  bias = (conv.bias.float() if conv.bias is not None
+          else torch.zeros(conv.out_channels, device=weight.device))
+  if norm is not None:
+    mean, inv_std = eval_bn_stats(norm)
+    weight = weight * inv_std.view(-1, 1, 1, 1)
+    bias = (bias - mean) * inv_std
+  out = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size,
+                  conv.stride, conv.padding, conv.dilation, conv.groups,
+                  bias=(conv.bias is not None or norm is not None))
+  out = out.to(conv.weight.device, conv.weight.dtype)
+  if conv.weight.is_contiguous(memory_format=torch.channels_last):
+    out = out.to(memory_format=torch.channels_last)
+  out.weight.copy_(weight)
+  if out.bias is not None:
+    out.bias.copy_(bias)
+  return out
+
+
+# Fold a linear layer's spectral norm into a plain nn.Linear
+def fold_linear(linear):
+  out = nn.Linear(linear.in_features, linear.out_features,
+                  bias=linear.bias is not None)
+  out = out.to(linear.weight.device, linear.weight.dtype)
+  out.weight.copy_(effective_weight(linear))
+  if out.bias is not None:
+    out.bias.copy_(linear.bias)
+  return out
+
+
+# Fold a ccbn into a ccaffine. If normalize is True, the eval-mode statistics
+# are folded into the class-conditional scale and shift; pass normalize=False
+# if they have already been folded into the preceding conv.
+def fold_ccbn(norm, activation=None, normalize=True):
+  if normalize:
+    mean, inv_std = eval_bn_stats(norm)
+  else:
+    mean = torch.zeros(norm.output_size, device=norm.gain.weight.device)
+    inv_std = torch.ones_like(mean)
+  # Without G_shared, the gains and biases are per-class embeddings
+  if isinstance(norm.gain, nn.Embedding):
+    scale = (1 + norm.gain.weight.float()) * inv_std
+    shift = norm.bias.weight.float() - mean * scale
+    linear = nn.Embedding(norm.gain.num_embeddings, 2 * norm.output_size)
+    linear.weight.data = torch.cat([scale, shift], 1)
+  # Otherwise, gain = 1 + W_g y + b_g and bias = W_b y + b_b, so the scale and
+  # shift are still linear in y, and can be computed by a single layer.
+  else:
+    weight_g, weight_b = [effective_weight(item).float()
+                          for item in [norm.gain, norm.bias]]
+    bias_g, bias_b = [item.bias.float() if item.bias is not None
+                      else torch.zeros_like(mean)
+                      for item in [norm.gain, norm.bias]]
+    scale_weight = weight_g * inv_std.view(-1, 1)
+    scale_bias = (1 + bias_g) * inv_std
+    linear = nn.Linear(norm.input_size, 2 * norm.output_size)
+    linear.weight.data = torch.cat([scale_weight,
+                                    weight_b - mean.view(-1, 1) * scale_weight], 0)
+    linear.bias.data = torch.cat([scale_bias, bias_b - mean * scale_bias], 0)
+  linear = linear.to(norm.gain.weight.device, norm.gain.weight.dtype)
+  return ccaffine(norm.output_size, linear, fused_activation(activation))
+
+
+# Fold a non-class-conditional bn into an affine
+def fold_bn(norm, activation=None):
+  mean, inv_std = eval_bn_stats(norm)
+  scale = norm.gain.float() * inv_std
+  shift = norm.bias.float() - mean * scale
+  return affine(scale.to(norm.gain.dtype), shift.to(norm.gain.dtype),
+                fused_activation(activation))
+
+
+# Nearest-neighbour 2x upsampling followed by a 3x3 conv with padding 1,
+# computed without materializing the upsampled input. Each output sub-pixel
+# (even/odd row, even/odd column) only sees a 2x2 window of the input, with
+# the 3x3 taps that land on the same input pixel summed, so the whole thing
+# is a single 2x2 conv with 4x the output channels (4/9 of the multiply-adds),
+# whose outputs are then interleaved.
+def subpixel_conv(x, conv):
+  weight = effective_weight(conv)
+  # Which of the 3 taps land on each of the 2 input pixels, for even and odd
+  # output rows (or columns)
+  phases = torch.tensor([[[1, 0, 0], [0, 1, 1]], [[1, 1, 0], [0, 0, 1]]],
+                        dtype=weight.dtype, device=weight.device)
+  weight = torch.einsum('ark,oikl,bcl->oabirc', phases, weight, phases)
+  weight = weight.reshape(-1, weight.shape[3], 2, 2)
+  bias = conv.bias.repeat_interleave(4) if conv.bias is not None else None
+  out = F.conv2d(F.pad(x, [1, 1, 1, 1]), weight, bias)
+  B, _, H, W = x.shape
+  out = out.view(B, -1, 2, 2, H + 1, W + 1)
+  # Interleave the sub-pixels, each of which is offset by its phase
+  h = torch.empty(B, out.shape[1], 2 * H, 2 * W, dtype=out.dtype, device=out.device,
+                  memory_format=(torch.channels_last
+                                 if x.is_contiguous(memory_format=torch.channels_last)
+                                 else torch.contiguous_format))
+  for a in range(2):
+    for b in range(2):
+      h[:, :, a::2, b::2] = out[:, :, a, b, a:a + H, b:b + W]
+  return h
+
+
+# A 3x3 conv with padding 1 followed by 2x2 average pooling, computed as a
+# single 4x4 conv with stride 2 and padding 1. The 4x4 kernel is the 3x3
+# kernel smeared over the 2x2 pooling window, so the conv only visits the
+# pooled output locations (16/36 of the multiply-adds) and the full-resolution
+# conv output is never materialized.
+def conv_avgpool(x, conv):
+  weight = effective_weight(conv)
+  weight = (F.pad(weight, [0, 1, 0, 1]) + F.pad(weight, [1, 0, 0, 1])
+            + F.pad(weight, [0, 1, 1, 0]) + F.pad(weight, [1, 0, 1, 0])) / 4
+  return F.conv2d(x, weight, conv.bias, stride=2, padding=1)
+
 
-                          
 # Generator blocks
 # Note that this class assumes the kernel size and padding (and any other
 # settings) have been selected in the main generator module and passed in
@@ -373,9 +707,11 @@ class bn(nn.Module):
 # size [which is actually the number of channels of the conditional info] must 
 # be preselected)
 class GBlock(nn.Module):
+  # Constant so that TorchScript only compiles the branch in use
+  __constants__ = ['subpixel']
   def __init__(self, in_channels, out_channels,
                which_conv=nn.Conv2d, which_bn=bn, activation=None, 
-               upsample=None):
+               upsample=None, subpixel=False):
     super(GBlock, self).__init__()
     
     self.in_channels, self.out_channels = in_channels, out_channels
@@ -385,7 +721,7 @@ class GBlock(nn.Module):
     # Conv layers
     self.conv1 = self.which_conv(self.in_channels, self.out_channels)
     self.conv2 = self.which_conv(self.out_channels, self.out_channels)
-    self.learnable_sc = in_channels != out_channels or upsample
+    self.learnable_sc = in_channels != out_channels or upsample is not None
     if self.learnable_sc:
       self.conv_sc = self.which_conv(in_channels, out_channels, 
                                      kernel_size=1, padding=0)
@@ -394,24 +730,45 @@ class GBlock(nn.Module):
     self.bn2 = self.which_bn(out_channels)
     # upsample layers
     self.upsample = upsample
+    # Fuse the (nearest) upsample into conv1 as a sub-pixel conv?
+    self.subpixel = subpixel
 
   def forward(self, x, y):
     h = self.activation(self.bn1(x, y))
-    if self.upsample:
-      h = self.upsample(h)
-      x = self.upsample(x)
-    h = self.conv1(h)
+    if self.upsample is not None and self.subpixel:
+      h = subpixel_conv(h, self.conv1)
+    else:
+      if self.upsample is not None:
+        h = self.upsample(h)
+      h = self.conv1(h)
     h = self.activation(self.bn2(h, y))
     h = self.conv2(h)
+    # The 1x1 shortcut conv commutes with upsampling, so run it at low res
     if self.learnable_sc:       
       x = self.conv_sc(x)
+    if self.upsample is not None:
+      x = self.upsample(x)
     return h + x
+
+  # Fold this block for inference: bn1 becomes a ccaffine with its statistics
+  # folded in, bn2's statistics are folded into conv1, and the activations are
+  # fused into the ccaffines. Must be called in eval mode under no_grad.
+  def fold(self):
+    self.bn1 = fold_ccbn(self.bn1, self.activation)
+    self.conv1 = fold_conv(self.conv1, self.bn2)
+    self.bn2 = fold_ccbn(self.bn2, self.activation, normalize=False)
+    self.conv2 = fold_conv(self.conv2)
+    if self.learnable_sc:
+      self.conv_sc = fold_conv(self.conv_sc)
+    self.activation = identity()
+    return self
     
     
 # Residual block for the discriminator
 class DBlock(nn.Module):
   def __init__(self, in_channels, out_channels, which_conv=SNConv2d, wide=True,
-               preactivation=False, activation=None, downsample=None,):
+               preactivation=False, activation=None, downsample=None,
+               fused_pool=False):
     super(DBlock, self).__init__()
     self.in_channels, self.out_channels = in_channels, out_channels
     # If using wide D (as in SA-GAN and BigGAN), change the channel pattern
@@ -420,6 +777,9 @@ class DBlock(nn.Module):
     self.preactivation = preactivation
     self.activation = activation
     self.downsample = downsample
+    # Compute conv2 + downsample as a single strided conv? Only valid for
+    # 2x2 average pooling after a 3x3 conv with padding 1.
+    self.fused_pool = fused_pool and downsample is not None
         
     # Conv layers
     self.conv1 = self.which_conv(self.in_channels, self.hidden_channels)
@@ -428,17 +788,20 @@ class DBlock(nn.Module):
     if self.learnable_sc:
       self.conv_sc = self.which_conv(in_channels, out_channels, 
                                      kernel_size=1, padding=0)
+    if self.fused_pool:
+      if not (isinstance(downsample, nn.AvgPool2d) and downsample.kernel_size == 2
+              and self.conv2.kernel_size == (3, 3) and self.conv2.padding == (1, 1)
+              and self.conv2.stride == (1, 1) and self.conv2.dilation == (1, 1)):
+        raise ValueError('fused_pool requires a 3x3 conv with padding 1 '
+                         'followed by AvgPool2d(2)')
+
+  # A 1x1 conv commutes with average pooling, so always downsample first and
+  # run conv_sc at the lower resolution.
   def shortcut(self, x):
-    if self.preactivation:
-      if self.learnable_sc:
-        x = self.conv_sc(x)
-      if self.downsample:
-        x = self.downsample(x)
-    else:
-      if self.downsample:
-        x = self.downsample(x)
-      if self.learnable_sc:
-        x = self.conv_sc(x)
+    if self.downsample:
+      x = self.downsample(x)
+    if self.learnable_sc:
+      x = self.conv_sc(x)
     return x
     
   def forward(self, x):
@@ -450,9 +813,12 @@ class DBlock(nn.Module):
     else:
       h = x    
     h = self.conv1(h)
-    h = self.conv2(self.activation(h))
-    if self.downsample:
-      h = self.downsample(h)     
+    if self.fused_pool:
+      h = conv_avgpool(self.activation(h), self.conv2)
+    else:
+      h = self.conv2(self.activation(h))
+      if self.downsample:
+        h = self.downsample(h)     
         
     return h + self.shortcut(x)
     
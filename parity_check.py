@@ -0,0 +1,128 @@
+''' Parity check
+   This script checks that the rewrites of G and D's layers (folding, the
+   sub-pixel conv and the fused conv and pooling) match the layers they
+   replace, on fixed random z, y and inputs in float32, for each model and
+   resolution requested. It prints the largest absolute difference of each
+   check, and exits with an error if any is above --parity_tol (or if any
+   check fails to run). All other settings are taken from the usual training
+   flags, e.g.
+   python parity_check.py --parity_models BigGAN_BigGANdeep
+     --G_ch 16 --D_ch 16 --batch_size 4 --G_shared --hier --shared_dim 32 '''
+import sys
+import copy
+import json
+
+import torch
+import torch.nn as nn
+
+# Import my stuff
+import utils
+import layers
+
+
+# The largest absolute difference between two outputs
+def max_diff(a, b):
+  return float((a.float() - b.float()).abs().max())
+
+
+# Run the checks for one model and resolution, and return the largest
+# absolute difference of each.
+def check(config, device):
+  model = __import__(config['model'])
+  out = {}
+  # Folding G: its eval-mode output, with and without spectral norm. A few
+  # training-mode forwards first give the BN running stats something to fold.
+  for G_param in ['SN', 'none']:
+    utils.seed_rng(config['seed'])
+    G = model.Generator(**{**config, 'G_param': G_param}).to(device)
+    z_, y_ = utils.prepare_z_y(config['batch_size'], G.dim_z,
+                               config['n_classes'], device=device)
+    with torch.no_grad():
+      for _ in range(3):
+        z_.sample_()
+        y_.sample_()
+        G(z_, G.shared(y_))
+      G.eval()
+      z_.sample_()
+      y_.sample_()
+      G_folded = copy.deepcopy(G).fold()
+      out['fold_%s' % G_param] = max_diff(G(z_, G.shared(y_)),
+                                          G_folded(z_, G_folded.shared(y_)))
+  # G_subpixel: subpixel_conv against nearest 2x upsampling then the 3x3
+  # conv, with and without spectral norm, GBlock's shortcut conv run before
+  # upsampling against after it, and the whole eval-mode G with and without
+  # it, with the same weights
+  utils.seed_rng(config['seed'])
+  x = torch.randn(config['batch_size'], 8, 8, 8, device=device)
+  upsample = nn.Upsample(scale_factor=2)
+  with torch.no_grad():
+    for name, conv in [('SN', layers.SNConv2d(8, 16, 3, padding=1)),
+                       ('none', nn.Conv2d(8, 16, 3, padding=1))]:
+      conv = conv.to(device).eval()
+      out['subpixel_conv_%s' % name] = max_diff(layers.subpixel_conv(x, conv),
+                                                conv(upsample(x)))
+    conv_sc = nn.Conv2d(8, 16, 1).to(device)
+    out['G_shortcut'] = max_diff(upsample(conv_sc(x)), conv_sc(upsample(x)))
+    G = model.Generator(**config).to(device).eval()
+    G_subpixel = model.Generator(**{**config, 'G_subpixel': True}).to(device)
+    G_subpixel.load_state_dict(G.state_dict())
+    G_subpixel.eval()
+    out['G_subpixel'] = max_diff(G(z_, G.shared(y_)),
+                                 G_subpixel(z_, G_subpixel.shared(y_)))
+  # D_fused_pool: conv_avgpool against the 3x3 conv then 2x2 average pooling,
+  # with and without spectral norm, DBlock's shortcut conv run after pooling
+  # against before it, and (for BigGAN, the only D that supports it) the
+  # whole eval-mode D with and without it, with the same weights
+  downsample = nn.AvgPool2d(2)
+  with torch.no_grad():
+    for name, conv in [('SN', layers.SNConv2d(8, 16, 3, padding=1)),
+                       ('none', nn.Conv2d(8, 16, 3, padding=1))]:
+      conv = conv.to(device).eval()
+      out['conv_avgpool_%s' % name] = max_diff(layers.conv_avgpool(x, conv),
+                                               downsample(conv(x)))
+    out['D_shortcut'] = max_diff(conv_sc(downsample(x)),
+                                 downsample(conv_sc(x)))
+    if config['model'] == 'BigGAN':
+      x = torch.randn(config['batch_size'], 3, config['resolution'],
+                      config['resolution'], device=device)
+      D = model.Discriminator(**config).to(device).eval()
+      D_fused = model.Discriminator(**{**config, 'D_fused_pool': True})
+      D_fused = D_fused.to(device)
+      D_fused.load_state_dict(D.state_dict())
+      D_fused.eval()
+      out['D_fused_pool'] = max_diff(D(x, y_), D_fused(x, y_))
+  return out
+
+
+def run(config):
+  # Update the config dict as train.py does, other than the resolution
+  config['n_classes'] = utils.nclass_dict[config['dataset']]
+  config['G_activation'] = utils.activation_dict[config['G_nl']]
+  config['D_activation'] = utils.activation_dict[config['D_nl']]
+  device = config['parity_device'] or ('cuda' if torch.cuda.is_available()
+                                       else 'cpu')
+  results, failed = [], []
+  for model in config['parity_models'].split('_'):
+    for resolution in [int(item) for item in config['parity_resolutions'].split('_')]:
+      print('Checking %s at %d...' % (model, resolution))
+      result = check({**config, 'model': model, 'resolution': resolution},
+                     device)
+      failed += ['%s at %d: %s' % (model, resolution, key)
+                 for key in result if result[key] > config['parity_tol']]
+      results.append({'model': model, 'resolution': resolution, **result})
+  print(json.dumps(results, indent=2))
+  if failed:
+    sys.exit('Parity checks failed (tolerance %g): %s'
+             % (config['parity_tol'], ', '.join(failed)))
+  print('All parity checks passed (tolerance %g)' % config['parity_tol'])
+
+
+def main():
+  # parse command line and run
+  parser = utils.prepare_parser()
+  parser = utils.add_parity_parser(parser)
+  config = vars(parser.parse_args())
+  run(config)
+
+if __name__ == '__main__':
+  main()
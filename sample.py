@@ -2,6 +2,7 @@
    This script loads a pretrained net and a weightsfile and sample '''
 import functools
 import math
+import time
 import numpy as np
 from tqdm import tqdm, trange
 
@@ -82,12 +83,38 @@ def run(config):
   else:
     print('G is in %s mode...' % ('training' if G.training else 'eval'))
     
-  #Sample function
-  sample = functools.partial(utils.sample, G=G, z_=z_, y_=y_, config=config)  
   if config['accumulate_stats']:
     print('Accumulating standing stats across %d accumulations...' % config['num_standing_accumulations'])
     utils.accumulate_standing_stats(G, z_, y_, config['n_classes'],
                                     config['num_standing_accumulations'])
+  
+  # Optionally fold BN stats and SN into G's weights for faster sampling
+  if config['G_fold']:
+    if config['G_eval_mode']:
+      # A folded G has no BN stats left to re-accumulate at each truncation,
+      # which only batched truncation curves do without
+      if (config['accumulate_stats'] and config['sample_trunc_curves']
+          and not config['batched_trunc_curves']):
+        raise ValueError('--G_fold cannot be used with --accumulate_stats '
+                         'and --sample_trunc_curves, as a folded G has no BN '
+                         'stats to re-accumulate at each truncation; use '
+                         '--batched_trunc_curves to keep the initial ones')
+      print('Folding G for inference...')
+      G.fold()
+    else:
+      print('G_fold requires G_eval_mode, not folding G...')
+
+  # Optionally compile G; a folded G is scripted instead
+  if config['compile']:
+    if config['G_fold'] and config['G_eval_mode']:
+      print('Scripting G...')
+      G = torch.jit.script(G)
+    else:
+      print('Compiling G...')
+      G = torch.compile(G)
+    
+  #Sample function
+  sample = functools.partial(utils.sample, G=G, z_=z_, y_=y_, config=config)  
     
   
   # Sample a number of images and save them to an NPZ, for use with TF-Inception
@@ -139,22 +166,47 @@ def run(config):
                                  normalize=True)
 
   # Get Inception Score and FID
-  get_inception_metrics = inception_utils.prepare_inception_metrics(config['dataset'], config['parallel'], config['no_fid'])
-  # Prepare a simple function get metrics that we use for trunc curves
-  def get_metrics():
-    sample = functools.partial(utils.sample, G=G, z_=z_, y_=y_, config=config)    
-    IS_mean, IS_std, FID = get_inception_metrics(sample, config['num_inception_images'], num_splits=10, prints=False)
+  get_inception_metrics = inception_utils.prepare_inception_metrics(
+    config['dataset'], config['parallel'], config['no_fid'],
+    config['channels_last'], config['inception_batch_size'],
+    config['pipeline_inception'], config['fid_backend'],
+    config['inception_fp16'], config['resolution'], 'cuda',
+    utils.dataset_fingerprint(**config), config['moments_root'],
+    config['extra_metrics'], config['knn_k'], config['kid_subsets'],
+    config['kid_subset_size'])
+  # Print a set of metrics along with the settings they were got with
+  def report(IS_mean, IS_std, FID, num_images, extra=None):
     # Prepare output string
     outstring = 'Using %s weights ' % ('ema' if config['use_ema'] else 'non-ema')
     outstring += 'in %s mode, ' % ('eval' if config['G_eval_mode'] else 'training')
     outstring += 'with noise variance %3.3f, ' % z_.var
-    outstring += 'over %d images, ' % config['num_inception_images']
+    outstring += 'over %d images, ' % num_images
     if config['accumulate_stats'] or not config['G_eval_mode']:
       outstring += 'with batch size %d, ' % G_batch_size
     if config['accumulate_stats']:
       outstring += 'using %d standing stat accumulations, ' % config['num_standing_accumulations']
     outstring += 'Itr %d: PYTORCH UNOFFICIAL Inception Score is %3.3f +/- %3.3f, PYTORCH UNOFFICIAL FID is %5.4f' % (state_dict['itr'], IS_mean, IS_std, FID)
+    outstring += ''.join([', %s is %5.4f' % item for item in sorted((extra or {}).items())])
     print(outstring)
+  # Prepare a simple function get metrics that we use for trunc curves
+  def get_metrics():
+    sample = functools.partial(utils.sample, G=G, z_=z_, y_=y_, config=config)    
+    IS_mean, IS_std, FID, extra = get_inception_metrics(sample, config['num_inception_images'], num_splits=10, prints=False, return_extra=True)
+    report(IS_mean, IS_std, FID, config['num_inception_images'], extra)
+  # Get all the points of a truncation curve at once, from the same z and y.
+  # Standing stats aren't re-accumulated per point, so they are the ones
+  # accumulated at the start: accumulate_standing_stats draws unit variance
+  # noise whatever z_.var is, so they would only differ by sampling noise.
+  def get_curve_metrics(variances):
+    num_images = utils.trunc_curve_images(config, len(variances))
+    sample_curve = functools.partial(
+      utils.sample_curve, G=G, z_=z_, y_=y_, variances=variances,
+      config=config, fused_batch_size=config['trunc_fused_batch_size'])
+    metrics = get_inception_metrics(sample_curve, num_images, num_splits=10,
+                                    prints=False, curve=True)
+    for var, point_images, (IS_mean, IS_std, FID) in zip(variances, num_images, metrics):
+      z_.var = var
+      report(IS_mean, IS_std, FID, point_images)
   if config['sample_inception_metrics']: 
     print('Calculating Inception metrics...')
     get_metrics()
@@ -163,14 +215,19 @@ def run(config):
   if config['sample_trunc_curves']:
     start, step, end = [float(item) for item in config['sample_trunc_curves'].split('_')]
     print('Getting truncation values for variance in range (%3.3f:%3.3f:%3.3f)...' % (start, step, end))
-    for var in np.arange(start, end + step, step):     
-      z_.var = var
-      # Optionally comment this out if you want to run with standing stats
-      # accumulated at one z variance setting
-      if config['accumulate_stats']:
-        utils.accumulate_standing_stats(G, z_, y_, config['n_classes'],
-                                    config['num_standing_accumulations'])
-      get_metrics()
+    start_time = time.perf_counter()
+    if config['batched_trunc_curves']:
+      get_curve_metrics(np.arange(start, end + step, step))
+    else:
+      for var in np.arange(start, end + step, step):     
+        z_.var = var
+        # Optionally comment this out if you want to run with standing stats
+        # accumulated at one z variance setting
+        if config['accumulate_stats']:
+          utils.accumulate_standing_stats(G, z_, y_, config['n_classes'],
+                                      config['num_standing_accumulations'])
+        get_metrics()
+    print('Truncation curve took %3.1fs' % (time.perf_counter() - start_time))
 def main():
   # parse command line and run    
   parser = utils.prepare_parser()
@@ -42,6 +42,9 @@ def run(config):
   config['n_classes'] = utils.nclass_dict[config['dataset']]
   config['G_activation'] = utils.activation_dict[config['G_nl']]
   config['D_activation'] = utils.activation_dict[config['D_nl']]
+  if config['toggle_grads']:
+    print('Warning: --toggle_grads is deprecated and has no effect, as G and '
+          'D\'s grads are now kept apart without toggling requires_grad')
   # By default, skip init if resuming training.
   if config['resume']:
     print('Skipping initialization for training resumption...')
@@ -87,6 +90,13 @@ def run(config):
     print('Casting D to fp16...')
     D = D.half()
     # Consider automatically reducing SN_eps?
+  # Optionally keep params and grads in flat buffers
+  if config['flat_params']:
+    print('Flattening G and D params...')
+    G.flat = utils.FlatParams(G)
+    D.flat = utils.FlatParams(D)
+    if config['ema']:
+      G_ema.flat = utils.FlatParams(G_ema)
   GD = model.G_D(G, D)
   print(G)
   print(D)
@@ -94,7 +104,8 @@ def run(config):
     *[sum([p.data.nelement() for p in net.parameters()]) for net in [G,D]]))
   # Prepare state dict, which holds things like epoch # and itr #
   state_dict = {'itr': 0, 'epoch': 0, 'save_num': 0, 'save_best_num': 0,
-                'best_IS': 0, 'best_FID': 999999, 'config': config}
+                'best_IS': 0, 'best_FID': 999999, 'best_quick_IS': 0,
+                'best_quick_FID': 999999, 'config': config}
 
   # If loading from a pre-trained model, load weights
   if config['resume']:
@@ -104,6 +115,12 @@ def run(config):
                        config['load_weights'] if config['load_weights'] else None,
                        G_ema if config['ema'] else None)
 
+  # Optionally capture GD's forward pass as a graph. G and D themselves are
+  # left uncompiled so that their state_dicts are unchanged.
+  if config['compile'] and not config['parallel']:
+    print('Compiling GD...')
+    GD = torch.compile(GD)
+
   # If parallel, parallelize the GD module
   if config['parallel']:
     GD = nn.DataParallel(GD)
@@ -118,6 +135,14 @@ def run(config):
   print('Inception Metrics will be saved to {}'.format(test_metrics_fname))
   test_log = utils.MetricsLogger(test_metrics_fname, 
                                  reinitialize=(not config['resume']))
+  # Quick and extra metrics get their own logs, leaving the test log's format
+  # as it was
+  quick_log = utils.MetricsLogger('%s/%s_quick_log.jsonl'
+                                  % (config['logs_root'], experiment_name),
+                                  reinitialize=(not config['resume']))
+  extra_log = utils.MetricsLogger('%s/%s_extra_log.jsonl'
+                                  % (config['logs_root'], experiment_name),
+                                  reinitialize=(not config['resume']))
   print('Training Metrics will be saved to {}'.format(train_metrics_fname))
   train_log = utils.MyLogger(train_metrics_fname, 
                              reinitialize=(not config['resume']),
@@ -133,8 +158,17 @@ def run(config):
   loaders = utils.get_data_loaders(**{**config, 'batch_size': D_batch_size,
                                       'start_itr': state_dict['itr']})
 
-  # Prepare inception metrics: FID and IS
-  get_inception_metrics = inception_utils.prepare_inception_metrics(config['dataset'], config['parallel'], config['no_fid'])
+  # Prepare inception metrics: FID and IS, unless an eval worker does them all
+  get_inception_metrics = None
+  if not config['async_eval'] or config['quick_test_every'] > 0:
+    get_inception_metrics = inception_utils.prepare_inception_metrics(
+      config['dataset'], config['parallel'], config['no_fid'],
+      config['channels_last'], config['inception_batch_size'],
+      config['pipeline_inception'], config['fid_backend'],
+      config['inception_fp16'], config['resolution'], 'cuda',
+      utils.dataset_fingerprint(**config), config['moments_root'],
+      config['extra_metrics'], config['knn_k'], config['kid_subsets'],
+      config['kid_subset_size'])
 
   # Prepare noise and randomly sampled label arrays
   # Allow for different batch sizes in G
@@ -147,10 +181,37 @@ def run(config):
                                        fp16=config['G_fp16'])  
   fixed_z.sample_()
   fixed_y.sample_()
+  # If using channels_last, check that no layers in G or D fall back to NCHW
+  memory_format = torch.preserve_format
+  if config['channels_last']:
+    memory_format = torch.channels_last
+    G.eval()
+    D.eval()
+    with torch.no_grad():
+      G_z = G(fixed_z, G.shared(fixed_y))
+      G_z = G_z.half() if config['D_fp16'] else G_z.float()
+    for net, inputs in [(G, (fixed_z, G.shared(fixed_y))), (D, (G_z, fixed_y))]:
+      fallbacks = utils.channels_last_report(net, *inputs)
+      if fallbacks:
+        print('Layers falling back to NCHW: %s' % ', '.join(fallbacks))
+  # Optionally time each phase of an iteration, including G and D's forward
+  # passes inside each step, and write a profiler trace for some iterations
+  timer = utils.PhaseTimer(config['phase_log_every'] > 0)
+  if ((config['phase_log_every'] > 0 or config['profile_itrs'])
+      and not (config['parallel'] or config['compile'])):
+    timer.time_module(G, 'G')
+    timer.time_module(D, 'D')
+  phase_log_every = train_fns.periodic(config['phase_log_every'])
+  if config['phase_log_every'] > 0:
+    phase_log = utils.MetricsLogger('%s/%s_phases.jsonl'
+                                    % (config['logs_root'], experiment_name),
+                                    reinitialize=(not config['resume']))
+  profiler = utils.IterationProfiler(config['profile_itrs'],
+                                     train_metrics_fname, timer)
   # Loaders are loaded, prepare the training function
   if config['which_train_fn'] == 'GAN':
     train = train_fns.GAN_training_function(G, D, GD, z_, y_, 
-                                            ema, state_dict, config)
+                                            ema, state_dict, config, timer)
   # Else, assume debugging and use the dummy train fn
   else:
     train = train_fns.dummy_training_function()
@@ -159,6 +220,9 @@ def run(config):
                               G=(G_ema if config['ema'] and config['use_ema']
                                  else G),
                               z_=z_, y_=y_, config=config)
+  # Schedules for logging singular values and getting quick metrics
+  sv_log_every = train_fns.periodic(config['sv_log_interval'])
+  quick_test_every = train_fns.periodic(config['quick_test_every'])
 
   print('Beginning training at epoch %d...' % state_dict['epoch'])
   # Train for specified number of epochs, although we mostly track G iterations.
@@ -169,26 +233,32 @@ def run(config):
       pbar = utils.progress(loaders[0],displaytype='s1k' if config['use_multiepoch_sampler'] else 'eta')
     else:
       pbar = tqdm(loaders[0])
+    # Time spent waiting on the loader
+    timer.start('data', host=True)
     for i, (x, y) in enumerate(pbar):
+      timer.stop()
       # Increment the iteration counter
       state_dict['itr'] += 1
+      profiler.step(state_dict['itr'])
       # Make sure G and D are in training mode, just in case they got set to eval
       # For D, which typically doesn't have BN, this shouldn't matter much.
       G.train()
       D.train()
       if config['ema']:
         G_ema.train()
-      if config['D_fp16']:
-        x, y = x.to(device).half(), y.to(device)
-      else:
-        x, y = x.to(device), y.to(device)
+      with timer.phase('to_device'):
+        if config['D_fp16']:
+          x, y = x.to(device, memory_format=memory_format).half(), y.to(device)
+        else:
+          x, y = x.to(device, memory_format=memory_format), y.to(device)
       metrics = train(x, y)
-      train_log.log(itr=int(state_dict['itr']), **metrics)
+      with timer.phase('log'):
+        train_log.log(itr=int(state_dict['itr']), **metrics)
       
-      # Every sv_log_interval, log singular values
-      if (config['sv_log_interval'] > 0) and (not (state_dict['itr'] % config['sv_log_interval'])):
-        train_log.log(itr=int(state_dict['itr']), 
-                      **{**utils.get_SVs(G, 'G'), **utils.get_SVs(D, 'D')})
+        # Every sv_log_interval, log singular values
+        if sv_log_every(state_dict['itr']):
+          train_log.log(itr=int(state_dict['itr']), 
+                        **{**utils.get_SVs(G, 'G'), **utils.get_SVs(D, 'D')})
 
       # If using my progbar, print metrics.
       if config['pbar'] == 'mine':
@@ -206,16 +276,38 @@ def run(config):
         train_fns.save_and_sample(G, D, G_ema, z_, y_, fixed_z, fixed_y, 
                                   state_dict, config, experiment_name)
 
-      # Test every specified interval
-      if not (state_dict['itr'] % config['test_every']):
+      # Get quick metrics every specified interval, and test if they improved
+      quick_improved = False
+      if quick_test_every(state_dict['itr']):
         if config['G_eval_mode']:
           print('Switchin G to eval mode...')
           G.eval()
-        train_fns.test(G, D, G_ema, z_, y_, state_dict, config, sample,
-                       get_inception_metrics, experiment_name, test_log)
+        quick_improved = train_fns.quick_test(
+          G_ema if config['ema'] and config['use_ema'] else G, z_, y_,
+          state_dict, config, sample, get_inception_metrics, quick_log)
+
+      # Test every specified interval
+      if not (state_dict['itr'] % config['test_every']) or quick_improved:
+        if config['async_eval']:
+          train_fns.snapshot(G, D, G_ema, state_dict, config, experiment_name)
+        else:
+          if config['G_eval_mode']:
+            print('Switchin G to eval mode...')
+            G.eval()
+          train_fns.test(G, D, G_ema, z_, y_, state_dict, config, sample,
+                         get_inception_metrics, experiment_name, test_log,
+                         extra_log)
+
+      # Every phase_log_every, log the times of each phase
+      timer.step()
+      if phase_log_every(state_dict['itr']):
+        phase_log.log(itr=int(state_dict['itr']), **timer.summary())
+      timer.start('data', host=True)
+    timer.stop()
 
     # Increment epoch counter at end of epoch
     state_dict['epoch'] += 1
+  profiler.close()
 
 
 def main():
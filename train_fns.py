@@ -5,9 +5,11 @@ import torch
 import torch.nn as nn
 import torchvision
 import os
+import json
 
 import utils
 import losses
+import layers
 
 
 # Dummy training function for debugging
@@ -17,76 +19,122 @@ def dummy_training_function():
   return train
 
 
-def GAN_training_function(G, D, GD, z_, y_, ema, state_dict, config):
+# Schedule for expensive regularizers and monitors which needn't run every
+# iteration. A term run every N iterations fires when itr % N == 0; regs
+# should have their strength multiplied by N, so that their average strength
+# per iteration is unchanged (as in lazy regularization). N <= 0 disables it.
+class periodic(object):
+  def __init__(self, every=1):
+    self.every = int(every)
+
+  def __call__(self, itr):
+    return self.every > 0 and not (itr % self.every)
+
+  # Strength multiplier for regs applied on this schedule
+  @property
+  def multiplier(self):
+    return float(max(self.every, 1))
+
+
+# If a utils.PhaseTimer is passed, the time spent in each phase of the
+# D and G steps is recorded in it.
+def GAN_training_function(G, D, GD, z_, y_, ema, state_dict, config,
+                          timer=None):
+  # Grads are kept out of the net that isn't being trained by the graph
+  # itself: in D's steps, G runs without grad, and in G's step, only grads
+  # with respect to G's params are taken. This makes toggling requires_grad
+  # on every param twice a step unnecessary.
+  G_params = list(G.parameters())
+  if timer is None:
+    timer = utils.PhaseTimer(enabled=False)
+  # Schedules for the periodic regs and diagnostics
+  D_ortho_every = periodic(config['D_ortho_every'])
+  G_ortho_every = periodic(config['G_ortho_every'])
+  grad_norm_every = periodic(config['grad_norm_every'])
+  # Prepare ortho reg plans once, rather than resolving parameters every step
+  if config['D_ortho'] > 0.0:
+    D_ortho = utils.ortho_reg(D, config['D_ortho'] * D_ortho_every.multiplier)
+  if config['G_ortho'] > 0.0:
+    # Don't ortho reg shared, it makes no sense. Really we should blacklist any embeddings for this
+    G_ortho = utils.ortho_reg(G, config['G_ortho'] * G_ortho_every.multiplier,
+                              blacklist=[param for param in G.shared.parameters()])
   def train(x, y):
-    G.optim.zero_grad()
-    D.optim.zero_grad()
+    itr = state_dict['itr']
+    utils.zero_grad(G)
+    utils.zero_grad(D)
     # How many chunks to split x and y into?
     x = torch.split(x, config['batch_size'])
     y = torch.split(y, config['batch_size'])
     counter = 0
     
-    # Optionally toggle D and G's "require_grad"
-    if config['toggle_grads']:
-      utils.toggle_grad(D, True)
-      utils.toggle_grad(G, False)
-      
     for step_index in range(config['num_D_steps']):
-      # If accumulating gradients, loop multiple times before an optimizer step
-      D.optim.zero_grad()
-      for accumulation_index in range(config['num_D_accumulations']):
-        z_.sample_()
-        y_.sample_()
-        D_fake, D_real = GD(z_[:config['batch_size']], y_[:config['batch_size']], 
-                            x[counter], y[counter], train_G=False, 
-                            split_D=config['split_D'])
+      # Optionally hold SN/BN buffer updates until after the optimizer step
+      with timer.phase('D_step'), layers.deferred_updates(config['deferred_updates']):
+        # If accumulating gradients, loop multiple times before an optimizer step
+        utils.zero_grad(D)
+        for accumulation_index in range(config['num_D_accumulations']):
+          with timer.phase('forward'):
+            z_.sample_()
+            y_.sample_()
+            D_fake, D_real = GD(z_[:config['batch_size']], y_[:config['batch_size']], 
+                                x[counter], y[counter], train_G=False, 
+                                split_D=config['split_D'])
          
-        # Compute components of D's loss, average them, and divide by 
-        # the number of gradient accumulations
-        D_loss_real, D_loss_fake = losses.discriminator_loss(D_fake, D_real)
-        D_loss = (D_loss_real + D_loss_fake) / float(config['num_D_accumulations'])
-        D_loss.backward()
-        counter += 1
+            # Compute components of D's loss, average them, and divide by 
+            # the number of gradient accumulations
+            D_loss_real, D_loss_fake = losses.discriminator_loss(D_fake, D_real)
+            D_loss = (D_loss_real + D_loss_fake) / float(config['num_D_accumulations'])
+          with timer.phase('backward'):
+            D_loss.backward()
+          counter += 1
         
-      # Optionally apply ortho reg in D
-      if config['D_ortho'] > 0.0:
-        # Debug print to indicate we're using ortho reg in D.
-        print('using modified ortho reg in D')
-        utils.ortho(D, config['D_ortho'])
+        # Optionally apply ortho reg in D
+        if config['D_ortho'] > 0.0 and D_ortho_every(itr):
+          # Debug print to indicate we're using ortho reg in D.
+          print('using modified ortho reg in D')
+          with timer.phase('ortho'):
+            D_ortho()
       
-      D.optim.step()
+        with timer.phase('optim'):
+          D.optim.step()
     
-    # Optionally toggle "requires_grad"
-    if config['toggle_grads']:
-      utils.toggle_grad(D, False)
-      utils.toggle_grad(G, True)
-      
-    # Zero G's gradients by default before training G, for safety
-    G.optim.zero_grad()
+    # Optionally hold SN/BN buffer updates until after the optimizer step
+    with timer.phase('G_step'), layers.deferred_updates(config['deferred_updates']):
+      # Zero G's gradients by default before training G, for safety
+      utils.zero_grad(G)
     
-    # If accumulating gradients, loop multiple times
-    for accumulation_index in range(config['num_G_accumulations']):    
-      z_.sample_()
-      y_.sample_()
-      D_fake = GD(z_, y_, train_G=True, split_D=config['split_D'])
-      G_loss = losses.generator_loss(D_fake) / float(config['num_G_accumulations'])
-      G_loss.backward()
+      # If accumulating gradients, loop multiple times
+      for accumulation_index in range(config['num_G_accumulations']):    
+        with timer.phase('forward'):
+          z_.sample_()
+          y_.sample_()
+          D_fake = GD(z_, y_, train_G=True, split_D=config['split_D'])
+          G_loss = losses.generator_loss(D_fake) / float(config['num_G_accumulations'])
+        # Only backprop into G's params, rather than toggling D's off
+        with timer.phase('backward'):
+          utils.accumulate_grads(G_params, torch.autograd.grad(G_loss, G_params,
+                                                               allow_unused=True))
     
-    # Optionally apply modified ortho reg in G
-    if config['G_ortho'] > 0.0:
-      print('using modified ortho reg in G') # Debug print to indicate we're using ortho reg in G
-      # Don't ortho reg shared, it makes no sense. Really we should blacklist any embeddings for this
-      utils.ortho(G, config['G_ortho'], 
-                  blacklist=[param for param in G.shared.parameters()])
-    G.optim.step()
+      # Optionally apply modified ortho reg in G
+      if config['G_ortho'] > 0.0 and G_ortho_every(itr):
+        print('using modified ortho reg in G') # Debug print to indicate we're using ortho reg in G
+        with timer.phase('ortho'):
+          G_ortho()
+      with timer.phase('optim'):
+        G.optim.step()
     
     # If we have an ema, update it, regardless of if we test with it or not
     if config['ema']:
-      ema.update(state_dict['itr'])
+      with timer.phase('ema'):
+        ema.update(state_dict['itr'])
     
     out = {'G_loss': float(G_loss.item()), 
             'D_loss_real': float(D_loss_real.item()),
             'D_loss_fake': float(D_loss_fake.item())}
+    # Optionally log the norms of the grads used in the last G and D steps
+    if grad_norm_every(itr):
+      out['G_grad_norm'] = float(utils.grad_norm(G).item())
+      out['D_grad_norm'] = float(utils.grad_norm(D).item())
     # Return G's loss and the components of D's loss.
     return out
   return train
@@ -107,6 +155,9 @@ def save_and_sample(G, D, G_ema, z_, y_, fixed_z, fixed_y,
                        'copy%d' %  state_dict['save_num'],
                        G_ema if config['ema'] else None)
     state_dict['save_num'] = (state_dict['save_num'] + 1 ) % config['num_save_copies']
+  # With an eval worker, the sheets are made from its snapshots instead
+  if config['async_eval']:
+    return
     
   # Use EMA G for samples or non-EMA?
   which_G = G_ema if config['ema'] and config['use_ema'] else G
@@ -157,18 +208,21 @@ def save_and_sample(G, D, G_ema, z_, y_, fixed_z, fixed_y,
 ''' This function runs the inception metrics code, checks if the results
     are an improvement over the previous best (either in IS or FID, 
     user-specified), logs the results, and saves a best_ copy if it's an 
-    improvement. '''
+    improvement. Any extra metrics (KID etc.) are logged to extra_log, so
+    that the test log keeps its fixed format. '''
 def test(G, D, G_ema, z_, y_, state_dict, config, sample, get_inception_metrics,
-         experiment_name, test_log):
+         experiment_name, test_log, extra_log=None):
   print('Gathering inception metrics...')
   if config['accumulate_stats']:
     utils.accumulate_standing_stats(G_ema if config['ema'] and config['use_ema'] else G,
                            z_, y_, config['n_classes'],
                            config['num_standing_accumulations'])
-  IS_mean, IS_std, FID = get_inception_metrics(sample, 
+  IS_mean, IS_std, FID, extra = get_inception_metrics(sample, 
                                                config['num_inception_images'],
-                                               num_splits=10)
+                                               num_splits=10, return_extra=True)
   print('Itr %d: PYTORCH UNOFFICIAL Inception Score is %3.3f +/- %3.3f, PYTORCH UNOFFICIAL FID is %5.4f' % (state_dict['itr'], IS_mean, IS_std, FID))
+  if extra:
+    print('Itr %d: %s' % (state_dict['itr'], ', '.join(['%s is %5.4f' % item for item in sorted(extra.items())])))
   # If improved over previous best metric, save approrpiate copy
   if ((config['which_best'] == 'IS' and IS_mean > state_dict['best_IS'])
     or (config['which_best'] == 'FID' and FID < state_dict['best_FID'])):
@@ -181,4 +235,60 @@ def test(G, D, G_ema, z_, y_, state_dict, config, sample, get_inception_metrics,
   state_dict['best_FID'] = min(state_dict['best_FID'], FID)
   # Log results to file
   test_log.log(itr=int(state_dict['itr']), IS_mean=float(IS_mean),
-               IS_std=float(IS_std), FID=float(FID))
\ No newline at end of file
+               IS_std=float(IS_std), FID=float(FID))
+  if extra and extra_log is not None:
+    extra_log.log(itr=int(state_dict['itr']), **extra)
+
+
+''' This function snapshots the weights for eval_worker.py, which computes
+    inception metrics, sample sheets and truncation curves from them in
+    another process, logs the results and keeps the best copies, so that
+    training doesn't wait on them. Only the G that is tested (G_ema or G)
+    and the state_dict are saved, as those are all the worker and sample.py
+    load. A .ready file marks the snapshot as complete. The bests the
+    worker has found so far are taken into state_dict first, so that the
+    trainer's checkpoints don't carry stale ones. '''
+def snapshot(G, D, G_ema, state_dict, config, experiment_name):
+  root = '%s/%s' % (config['weights_root'], experiment_name)
+  state_fname = '%s/eval_worker_state.json' % root
+  if os.path.exists(state_fname):
+    with open(state_fname) as f:
+      state_dict.update(json.load(f))
+  name_suffix = 'eval%d' % state_dict['itr']
+  which_G = 'G_ema' if config['ema'] and config['use_ema'] else 'G'
+  print('Saving %s snapshot to %s/%s...' % (which_G, root, name_suffix))
+  torch.save((G_ema if which_G == 'G_ema' else G).state_dict(),
+             '%s/%s.pth' % (root, utils.join_strings('_', [which_G, name_suffix])))
+  torch.save(state_dict,
+             '%s/%s.pth' % (root, utils.join_strings('_', ['state_dict', name_suffix])))
+  open('%s/%s.ready' % (root, name_suffix), 'w').close()
+
+
+''' This function gets cheap inception metrics on a small number of samples,
+    with FID extrapolated to infinitely many samples (FID_inf) to remove
+    most of FID's small-sample bias, and logs them. It returns whether they
+    are an improvement over the previous best quick estimate (either in IS
+    or FID, user-specified), in which case a full test is worth running.
+    Without extrapolation (num_FID_points < 2), the quick FID stands in for
+    FID_inf. The results go to their own log (quick_log), so that the test
+    log keeps its fixed format. '''
+def quick_test(G, z_, y_, state_dict, config, sample, get_inception_metrics,
+               quick_log):
+  print('Gathering quick inception metrics...')
+  if config['accumulate_stats']:
+    utils.accumulate_standing_stats(G, z_, y_, config['n_classes'],
+                                    config['num_standing_accumulations'])
+  outputs = get_inception_metrics(
+    sample, config['num_quick_inception_images'], num_splits=10,
+    prints=False, num_FID_points=config['num_FID_points'])
+  IS_mean, IS_std, FID = outputs[:3]
+  FID_inf = outputs[3] if config['num_FID_points'] > 1 else FID
+  print('Itr %d: quick Inception Score is %3.3f +/- %3.3f, quick FID is %5.4f, FID_inf is %5.4f' % (state_dict['itr'], IS_mean, IS_std, FID, FID_inf))
+  improved = ((config['which_best'] == 'IS' and IS_mean > state_dict['best_quick_IS'])
+              or (config['which_best'] == 'FID' and FID_inf < state_dict['best_quick_FID']))
+  state_dict['best_quick_IS'] = max(state_dict['best_quick_IS'], IS_mean)
+  state_dict['best_quick_FID'] = min(state_dict['best_quick_FID'], FID_inf)
+  quick_log.log(itr=int(state_dict['itr']), quick_IS_mean=float(IS_mean),
+                quick_IS_std=float(IS_std), quick_FID=float(FID),
+                quick_FID_inf=float(FID_inf))
+  return improved
\ No newline at end of file
@@ -15,6 +15,10 @@ import time
 import datetime
 import json
 import pickle
+import hashlib
+import functools
+import contextlib
+import collections
 from argparse import ArgumentParser
 import animal_hash
 
@@ -121,6 +125,26 @@ def prepare_parser():
     '--D_attn', type=str, default='64',
     help='What resolutions to use attention on for D (underscore separated) '
          '(default: %(default)s)')
+  parser.add_argument(
+    '--G_checkpoint', type=str, default='0',
+    help='What resolutions of G blocks to run under activation checkpointing, '
+         'recomputing their activations in backward instead of storing them '
+         '(underscore separated) (default: %(default)s)')
+  parser.add_argument(
+    '--D_checkpoint', type=str, default='0',
+    help='What resolutions of D blocks to run under activation checkpointing, '
+         'recomputing their activations in backward instead of storing them '
+         '(underscore separated) (default: %(default)s)')
+  parser.add_argument(
+    '--G_subpixel', action='store_true', default=False,
+    help='Compute the upsample + 3x3 conv in G''s blocks as a single sub-pixel '
+         'conv, without materializing the upsampled input? Weights are '
+         'unchanged (default: %(default)s)')
+  parser.add_argument(
+    '--D_fused_pool', action='store_true', default=False,
+    help='Compute the 3x3 conv + 2x2 avgpool in D''s downsampling blocks as a '
+         'single stride-2 4x4 conv? BigGAN only; weights are unchanged '
+         '(default: %(default)s)')
   parser.add_argument(
     '--norm_style', type=str, default='bn',
     help='Normalizer style for G, one of bn [batchnorm], in [instancenorm], '
@@ -183,12 +207,27 @@ def prepare_parser():
   parser.add_argument(
     '--split_D', action='store_true', default=False,
     help='Run D twice rather than concatenating inputs? (default: %(default)s)')
+  parser.add_argument(
+    '--deferred_updates', action='store_true', default=False,
+    help='Hold SN singular vector and BN running stat updates until after '
+         'each optimizer step, so that running (or recomputing) a forward '
+         'more than once per step doesn''t update them more than once? '
+         '(default: %(default)s)')
   parser.add_argument(
     '--num_epochs', type=int, default=100,
     help='Number of epochs to train for (default: %(default)s)')
   parser.add_argument(
     '--parallel', action='store_true', default=False,
     help='Train with multiple GPUs (default: %(default)s)')
+  parser.add_argument(
+    '--compile', action='store_true', default=False,
+    help='Compile G and D''s forward passes with torch.compile (not used '
+         'with --parallel); in sample.py, a folded G is scripted with '
+         'torch.jit.script instead (default: %(default)s)')
+  parser.add_argument(
+    '--channels_last', action='store_true', default=False,
+    help='Use the channels_last memory format for G, D, Inception, and the '
+         'data? (default: %(default)s)')
   parser.add_argument(
     '--G_fp16', action='store_true', default=False,
     help='Train with half-precision in G? (default: %(default)s)')
@@ -203,6 +242,11 @@ def prepare_parser():
     '--G_mixed_precision', action='store_true', default=False,
     help='Train with half-precision activations but fp32 params in G? '
          '(default: %(default)s)')
+  parser.add_argument(
+    '--flat_params', action='store_true', default=False,
+    help='Keep G, D (and G_ema) params and grads in single flat buffers, so '
+         'that zeroing grads and EMA updates are single ops? '
+         '(default: %(default)s)')
   parser.add_argument(
     '--accumulate_stats', action='store_true', default=False,
     help='Accumulate "standing" batchnorm stats? (default: %(default)s)')
@@ -232,6 +276,33 @@ def prepare_parser():
   parser.add_argument(
     '--no_fid', action='store_true', default=False,
     help='Calculate IS only, not FID? (default: %(default)s)')
+  parser.add_argument(
+    '--fid_backend', type=str, default='newton_schulz',
+    choices=['eigh', 'newton_schulz', 'scipy'],
+    help='How to get the matrix sqrt for FID: with 50 float32 Newton-Schulz '
+         'itrs (newton_schulz), exactly via a symmetric eigendecomposition '
+         '(eigh), or with scipy\'s sqrtm. eigh\'s FIDs differ slightly from '
+         'newton_schulz\'s, so only compare runs that used the same backend '
+         '(default: %(default)s)')
+  parser.add_argument(
+    '--extra_metrics', type=str, default='',
+    help='Metrics to get from the same samples as IS and FID when testing, '
+         'joined by underscores: any of KID, PR (improved precision and '
+         'recall) and DC (density and coverage), e.g. KID_PR_DC. These need '
+         'the data features, kept by running calculate_inception_moments.py '
+         'with --num_real_features, e.g. 50000 (default: %(default)s)')
+  parser.add_argument(
+    '--knn_k', type=int, default=3,
+    help='Number of nearest neighbours for the radii used by PR and DC '
+         '(default: %(default)s)')
+  parser.add_argument(
+    '--kid_subsets', type=int, default=100,
+    help='Number of random subsets to average KID over '
+         '(default: %(default)s)')
+  parser.add_argument(
+    '--kid_subset_size', type=int, default=1000,
+    help='Number of real and fake images in each KID subset '
+         '(default: %(default)s)')
   parser.add_argument(
     '--test_every', type=int, default=5000,
     help='Test every X iterations (default: %(default)s)')
@@ -239,6 +310,39 @@ def prepare_parser():
     '--num_inception_images', type=int, default=50000,
     help='Number of samples to compute inception metrics with '
          '(default: %(default)s)')
+  parser.add_argument(
+    '--async_eval', action='store_true', default=False,
+    help='Instead of testing and saving sample sheets in the training loop, '
+         'snapshot the weights for eval_worker.py to evaluate in another '
+         'process (default: %(default)s)')
+  parser.add_argument(
+    '--quick_test_every', type=int, default=0,
+    help='Get quick IS and FID_inf estimates on num_quick_inception_images '
+         'images every X iterations, and do a full test on top of the ones '
+         'every test_every iterations whenever the quick estimate is a new '
+         'best; 0 for no quick estimates (default: %(default)s)')
+  parser.add_argument(
+    '--num_quick_inception_images', type=int, default=5000,
+    help='Number of samples to get quick inception metrics with '
+         '(default: %(default)s)')
+  parser.add_argument(
+    '--num_FID_points', type=int, default=5,
+    help='Number of sample sizes, from half of num_quick_inception_images '
+         'to all of them, to extrapolate FID_inf from (default: %(default)s)')
+  parser.add_argument(
+    '--inception_batch_size', type=int, default=0,
+    help='Batch size to run Inception with when computing inception '
+         'metrics; 0 to use G\'s batch size, or -1 to use the largest that '
+         'fits on the GPU (default: %(default)s)')
+  parser.add_argument(
+    '--inception_fp16', action='store_true', default=False,
+    help='Run Inception in float16 when computing inception metrics? '
+         '(default: %(default)s)')
+  parser.add_argument(
+    '--pipeline_inception', action='store_true', default=False,
+    help='Sample the next batch from G while Inception runs on the '
+         'current one, when computing inception metrics '
+         '(default: %(default)s)')
   parser.add_argument(
     '--hashname', action='store_true', default=False,
     help='Use a hash of the experiment name instead of the full config '
@@ -259,6 +363,10 @@ def prepare_parser():
   parser.add_argument(
     '--samples_root', type=str, default='samples',
     help='Default location to store samples (default: %(default)s)')  
+  parser.add_argument(
+    '--moments_root', type=str, default='moments',
+    help='Default location to store datasets\' Inception moments '
+         '(default: %(default)s)')
   parser.add_argument(
     '--pbar', type=str, default='mine',
     help='Type of progressbar to use; one of "mine" or "tqdm" '
@@ -321,9 +429,18 @@ def prepare_parser():
     '--D_ortho', type=float, default=0.0,
     help='Modified ortho reg coefficient in D (default: %(default)s)')
   parser.add_argument(
-    '--toggle_grads', action='store_true', default=True,
-    help='Toggle D and G''s "requires_grad" settings when not training them? '
-         ' (default: %(default)s)')
+    '--G_ortho_every', type=int, default=1,
+    help='Apply ortho reg in G every this many iterations, at its strength '
+         'times this interval (default: %(default)s)')
+  parser.add_argument(
+    '--D_ortho_every', type=int, default=1,
+    help='Apply ortho reg in D every this many iterations, at its strength '
+         'times this interval (default: %(default)s)')
+  parser.add_argument(
+    '--toggle_grads', action='store_true', default=False,
+    help='Deprecated, and has no effect: G and D''s grads are now kept apart '
+         'without toggling their "requires_grad" settings '
+         '(default: %(default)s)')
   
   ### Which train function ###
   parser.add_argument(
@@ -359,6 +476,20 @@ def prepare_parser():
     '--sv_log_interval', type=int, default=10,
     help='Iteration interval for logging singular values '
          ' (default: %(default)s)') 
+  parser.add_argument(
+    '--grad_norm_every', type=int, default=0,
+    help='Iteration interval for logging G and D\'s grad norms; '
+         '0 to never log them (default: %(default)s)')
+  parser.add_argument(
+    '--phase_log_every', type=int, default=0,
+    help='Iteration interval for logging the time spent in each phase of '
+         'an iteration (median, p90 and max over the interval, in ms); '
+         '0 to not time phases (default: %(default)s)')
+  parser.add_argument(
+    '--profile_itrs', type=str, default='',
+    help='Range of iterations (e.g. 100-105) to write a torch.profiler '
+         'trace for in the logs folder; empty for no trace '
+         '(default: %(default)s)')
    
   return parser
 
@@ -398,6 +529,91 @@ def add_sample_parser(parser):
   parser.add_argument(
     '--sample_inception_metrics', action='store_true', default=False,
     help='Calculate Inception metrics with sample.py? (default: %(default)s)')  
+  parser.add_argument(
+    '--batched_trunc_curves', action='store_true', default=False,
+    help='Get all the points of --sample_trunc_curves together, from the '
+         'same z and y, with fused G forwards for all the variances when G is '
+         'in eval mode. eval_worker.py always gets its curves this way '
+         '(default: %(default)s)')
+  parser.add_argument(
+    '--trunc_fused_batch_size', type=int, default=0,
+    help='With --batched_trunc_curves, the largest batch the fused G forward '
+         'runs with, larger ones being split; 0 to use the batch size G '
+         'samples with '
+         '(default: %(default)s)')
+  parser.add_argument(
+    '--trunc_early_images', type=int, default=0,
+    help='With --batched_trunc_curves, use this many images for every point '
+         'but the last, rather than --num_inception_images; 0 to use '
+         '--num_inception_images for all (default: %(default)s)')
+  parser.add_argument(
+    '--G_fold', action='store_true', default=False,
+    help='Fold G''s eval-mode BN stats and spectral norms into its weights '
+         'for faster sampling? Only used with --G_eval_mode '
+         '(default: %(default)s)')
+  return parser
+
+# Arguments for parity_check.py
+def add_parity_parser(parser):
+  parser.add_argument(
+    '--parity_models', type=str, default='BigGAN_BigGANdeep',
+    help='Model modules to check, separated by underscores '
+         '(default: %(default)s)')
+  parser.add_argument(
+    '--parity_resolutions', type=str, default='32',
+    help='Resolutions to check, separated by underscores '
+         '(default: %(default)s)')
+  parser.add_argument(
+    '--parity_device', type=str, default='',
+    help='Device to check on; cuda if available and cpu otherwise if not '
+         'specified (default: %(default)s)')
+  parser.add_argument(
+    '--parity_tol', type=float, default=1e-4,
+    help='Largest absolute difference allowed between a rewrite\'s output '
+         'and the original\'s (default: %(default)s)')
+  return parser
+
+# Arguments for eval_worker.py, on top of those for sample.py
+def add_eval_worker_parser(parser):
+  parser.add_argument(
+    '--eval_device', type=str, default='',
+    help='Device to evaluate on; cuda if available and cpu otherwise if '
+         'not specified (default: %(default)s)')
+  parser.add_argument(
+    '--eval_poll_interval', type=float, default=60,
+    help='Seconds to wait between checks for new snapshots '
+         '(default: %(default)s)')
+  parser.add_argument(
+    '--eval_once', action='store_true', default=False,
+    help='Evaluate the snapshots that are ready and exit, rather than '
+         'waiting for more (default: %(default)s)')
+  return parser
+
+# Arguments for benchmark.py
+def add_benchmark_parser(parser):
+  parser.add_argument(
+    '--bench_models', type=str, default='BigGAN',
+    help='Model modules to benchmark, separated by underscores, e.g. '
+         'BigGAN_BigGANdeep (default: %(default)s)')
+  parser.add_argument(
+    '--bench_resolutions', type=str, default='32_64_128',
+    help='Resolutions to benchmark, separated by underscores '
+         '(default: %(default)s)')
+  parser.add_argument(
+    '--bench_itrs', type=int, default=10,
+    help='Number of timed iterations per benchmark (default: %(default)s)')
+  parser.add_argument(
+    '--bench_warmup', type=int, default=2,
+    help='Number of untimed warmup iterations per benchmark '
+         '(default: %(default)s)')
+  parser.add_argument(
+    '--bench_device', type=str, default='',
+    help='Device to benchmark on; cuda if available and cpu otherwise if '
+         'not specified (default: %(default)s)')
+  parser.add_argument(
+    '--bench_out', type=str, default='',
+    help='JSON file to write the results to, as well as printing them '
+         '(default: %(default)s)')
   return parser
 
 # Convenience dicts
@@ -525,6 +741,75 @@ class MultiEpochSampler(torch.utils.data.Sampler):
     return len(self.data_source) * self.num_epochs - self.start_itr * self.batch_size
 
 
+# The transform that images from the dataset are loaded with. HDF5 datasets
+# have their own inbuilt transform, so there is none for them.
+def get_train_transform(dataset, augment=False):
+  norm_mean = [0.5,0.5,0.5]
+  norm_std = [0.5,0.5,0.5]
+  image_size = imsize_dict[dataset]
+  if 'hdf5' in dataset:
+    return None
+  if augment:
+    if dataset in ['C10', 'C100']:
+      train_transform = [transforms.RandomCrop(32, padding=4),
+                         transforms.RandomHorizontalFlip()]
+    else:
+      train_transform = [RandomCropLongEdge(),
+                       transforms.Resize(image_size),
+                       transforms.RandomHorizontalFlip()]
+  else:
+    if dataset in ['C10', 'C100']:
+      train_transform = []
+    else:
+      train_transform = [CenterCropLongEdge(), transforms.Resize(image_size)]
+    # train_transform = [transforms.Resize(image_size), transforms.CenterCrop]
+  return transforms.Compose(train_transform + [
+                   transforms.ToTensor(),
+                   transforms.Normalize(norm_mean, norm_std)])
+
+
+# A fingerprint of a dataset's images and the transform they're loaded with
+# (without augmentation, which the moments don't depend on), which keys its
+# Inception moments in inception_utils.MomentsStore. Rather than hashing
+# every image, HDF5 files are identified by their size, shape and labels, and
+# image folders by their index file, which is made here as the loader would
+# make it if it doesn't exist yet, so the folders are only walked once.
+# Other datasets (e.g. CIFAR's few files) are identified by the names and
+# sizes of their files. Returns None if the data isn't here.
+def dataset_fingerprint(dataset, data_root='data', **kwargs):
+  root = '%s/%s' % (data_root, root_dict[dataset])
+  index_filename = '%s_imgs.npz' % dataset
+  fingerprint = hashlib.sha1(dataset.encode())
+  if (dset_dict[dataset] is dset.ImageFolder and os.path.isdir(root)
+      and not os.path.exists(index_filename)):
+    print('Generating  Index file %s...' % index_filename)
+    classes, class_to_idx = dset.find_classes(root)
+    np.savez_compressed(index_filename,
+                        **{'imgs': dset.make_dataset(root, class_to_idx)})
+  if 'hdf5' in dataset:
+    if not os.path.exists(root):
+      return None
+    import h5py as h5
+    with h5.File(root, 'r') as f:
+      fingerprint.update(str((os.path.getsize(root), f['imgs'].shape,
+                              f['imgs'].dtype)).encode())
+      fingerprint.update(np.ascontiguousarray(f['labels'][:]).tobytes())
+  elif os.path.exists(index_filename):
+    fingerprint.update(np.ascontiguousarray(
+      np.load(index_filename)['imgs']).tobytes())
+  elif os.path.isdir(root):
+    for path, dirs, files in sorted(os.walk(root)):
+      dirs.sort()
+      for fname in sorted(files):
+        fname = os.path.join(path, fname)
+        fingerprint.update(str((os.path.relpath(fname, root),
+                                os.path.getsize(fname))).encode())
+  else:
+    return None
+  fingerprint.update(repr(get_train_transform(dataset)).encode())
+  return fingerprint.hexdigest()[:16]
+
+
 # Convenience function to centralize all data loaders
 def get_data_loaders(dataset, data_root=None, augment=False, batch_size=64, 
                      num_workers=8, shuffle=True, load_in_mem=False, hdf5=False,
@@ -537,36 +822,14 @@ def get_data_loaders(dataset, data_root=None, augment=False, batch_size=64,
   print('Using dataset root location %s' % data_root)
 
   which_dataset = dset_dict[dataset]
-  norm_mean = [0.5,0.5,0.5]
-  norm_std = [0.5,0.5,0.5]
-  image_size = imsize_dict[dataset]
   # For image folder datasets, name of the file where we store the precomputed
   # image locations to avoid having to walk the dirs every time we load.
   dataset_kwargs = {'index_filename': '%s_imgs.npz' % dataset}
   
-  # HDF5 datasets have their own inbuilt transform, no need to train_transform  
-  if 'hdf5' in dataset:
-    train_transform = None
-  else:
-    if augment:
-      print('Data will be augmented...')
-      if dataset in ['C10', 'C100']:
-        train_transform = [transforms.RandomCrop(32, padding=4),
-                           transforms.RandomHorizontalFlip()]
-      else:
-        train_transform = [RandomCropLongEdge(),
-                         transforms.Resize(image_size),
-                         transforms.RandomHorizontalFlip()]
-    else:
-      print('Data will not be augmented...')
-      if dataset in ['C10', 'C100']:
-        train_transform = []
-      else:
-        train_transform = [CenterCropLongEdge(), transforms.Resize(image_size)]
-      # train_transform = [transforms.Resize(image_size), transforms.CenterCrop]
-    train_transform = transforms.Compose(train_transform + [
-                     transforms.ToTensor(),
-                     transforms.Normalize(norm_mean, norm_std)])
+  if 'hdf5' not in dataset:
+    print('Data will be augmented...' if augment
+          else 'Data will not be augmented...')
+  train_transform = get_train_transform(dataset, augment)
   train_set = which_dataset(root=data_root, transform=train_transform,
                             load_in_mem=load_in_mem, **dataset_kwargs)
 
@@ -600,7 +863,7 @@ def seed_rng(seed):
 def update_config_roots(config):
   if config['base_root']:
     print('Pegging all root folders to base root %s' % config['base_root'])
-    for key in ['data', 'weights', 'logs', 'samples']:
+    for key in ['data', 'weights', 'logs', 'samples', 'moments']:
       config['%s_root' % key] = '%s/%s' % (config['base_root'], key)
   return config
 
@@ -640,6 +903,19 @@ class ema(object):
     else:
       decay = self.decay
     with torch.no_grad():
+      # If both models' params are flat, update them all at once, and then
+      # the buffers one by one; integer buffers (e.g. BN's
+      # num_batches_tracked) can't be interpolated, so are copied
+      if (getattr(self.source, 'flat', None) is not None
+          and getattr(self.target, 'flat', None) is not None):
+        for target, source in zip(self.target.flat.params, self.source.flat.params):
+          target.lerp_(source, 1 - decay)
+        for target, source in zip(self.target.buffers(), self.source.buffers()):
+          if target.is_floating_point():
+            target.lerp_(source, 1 - decay)
+          else:
+            target.copy_(source)
+        return
       for key in self.source_dict:
         self.target_dict[key].data.copy_(self.target_dict[key].data * decay 
                                      + self.source_dict[key].data * (1 - decay))
@@ -654,12 +930,46 @@ def ortho(model, strength=1e-4, blacklist=[]):
       # Only apply this to parameters with at least 2 axes, and not in the blacklist
       if len(param.shape) < 2 or any([param is item for item in blacklist]):
         continue
-      w = param.view(param.shape[0], -1)
+      w = param.reshape(param.shape[0], -1)
       grad = (2 * torch.mm(torch.mm(w, w.t()) 
               * (1. - torch.eye(w.shape[0], device=w.device)), w))
       param.grad.data += strength * grad.view(param.shape)
 
 
+# Modified ortho reg with a precomputed plan, for calling every step in
+# place of ortho(). The parameters to regularize are resolved against the
+# blacklist once and grouped by matrix shape, so that each group's gradient
+# takes two batched matmuls, with a cached off-diagonal mask that also folds
+# in the factor of 2 and the strength. All the gradients are then added into
+# the params' .grads (allocated if missing) with a single multi-tensor add.
+class ortho_reg(object):
+  def __init__(self, model, strength=1e-4, blacklist=[]):
+    self.strength = strength
+    blacklist = set(id(item) for item in blacklist)
+    # Group parameters with at least 2 axes by (rows, cols, dtype, device)
+    self.groups = {}
+    for param in model.parameters():
+      if len(param.shape) < 2 or id(param) in blacklist:
+        continue
+      key = (param.shape[0], param[0].numel(), param.dtype, param.device)
+      self.groups.setdefault(key, []).append(param)
+    self.masks = {key: 2 * strength * (1. - torch.eye(key[0], dtype=key[2], device=key[3]))
+                  for key in self.groups}
+
+  def __call__(self):
+    with torch.no_grad():
+      params, grads = [], []
+      for key, group in self.groups.items():
+        w = torch.stack([param.reshape(key[0], key[1]) for param in group])
+        out = torch.bmm(torch.bmm(w, w.transpose(1, 2)) * self.masks[key], w)
+        params += group
+        grads += [grad.view(param.shape) for param, grad in zip(group, out)]
+      for param in params:
+        if param.grad is None:
+          param.grad = torch.zeros_like(param)
+      torch._foreach_add_([param.grad for param in params], grads)
+
+
 # Default ortho reg
 # This function is an optimized version that directly computes the gradient,
 # instead of computing and then differentiating the loss.
@@ -669,12 +979,32 @@ def default_ortho(model, strength=1e-4, blacklist=[]):
       # Only apply this to parameters with at least 2 axes & not in blacklist
       if len(param.shape) < 2 or param in blacklist:
         continue
-      w = param.view(param.shape[0], -1)
+      w = param.reshape(param.shape[0], -1)
       grad = (2 * torch.mm(torch.mm(w, w.t()) 
                - torch.eye(w.shape[0], device=w.device), w))
       param.grad.data += strength * grad.view(param.shape)
 
 
+# Zero a model's grads, with a single op if its params are flat
+def zero_grad(net):
+  if getattr(net, 'flat', None) is not None:
+    net.flat.zero_grad()
+  else:
+    net.optim.zero_grad()
+
+
+# Add grads (e.g. from torch.autograd.grad) into params' .grad, as backward
+# would; None grads (for unused params) are skipped
+def accumulate_grads(params, grads):
+  for param, grad in zip(params, grads):
+    if grad is None:
+      continue
+    if param.grad is None:
+      param.grad = grad
+    else:
+      param.grad.add_(grad)
+
+
 # Convenience utility to switch off requires_grad
 def toggle_grad(model, on_or_off):
   for param in model.parameters():
@@ -735,9 +1065,12 @@ def load_weights(G, D, state_dict, weights_root, experiment_name,
     if load_optim:
       D.optim.load_state_dict(
         torch.load('%s/%s.pth' % (root, join_strings('_', ['D_optim', name_suffix]))))
-  # Load state dict
+  # Load state dict, keeping the defaults of any items missing from older
+  # checkpoints
+  saved_state_dict = torch.load('%s/%s.pth' % (root, join_strings('_', ['state_dict', name_suffix])))
   for item in state_dict:
-    state_dict[item] = torch.load('%s/%s.pth' % (root, join_strings('_', ['state_dict', name_suffix])))[item]
+    if item in saved_state_dict:
+      state_dict[item] = saved_state_dict[item]
   if G_ema is not None:
     G_ema.load_state_dict(
       torch.load('%s/%s.pth' % (root, join_strings('_', ['G_ema', name_suffix]))),
@@ -812,6 +1145,152 @@ class MyLogger(object):
           f.write('%s: %d: %s\n' % (datetime.datetime.now(), itr, self.logstyle % kwargs[arg]))
 
 
+# Per-phase wall clock timer for the training loop. Phases nest, and are
+# named after all their enclosing phases, e.g. D_step_forward_G. On GPU,
+# phases are timed with CUDA events which are only resolved when a summary
+# is taken, so timing adds no syncs; host phases (e.g. waiting on data) and
+# all phases on CPU use perf_counter. Times are summed over each iteration,
+# and summary() gives the median, p90 and max per phase over the iterations
+# since the last summary, in ms. While profiling is set (by an
+# IterationProfiler), phases are labeled in the trace even if timing is off.
+class PhaseTimer(object):
+  def __init__(self, enabled=True, cuda=None):
+    self.enabled = enabled
+    self.cuda = torch.cuda.is_available() if cuda is None else cuda
+    # Label phases in profiler traces?
+    self.profiling = False
+    self.stack = []
+    self.records = []
+    self.itrs = []
+
+  def start(self, name, host=False):
+    if not (self.enabled or self.profiling):
+      return
+    if self.stack:
+      name = '%s_%s' % (self.stack[-1][0], name)
+    # Phases which are only labeled have no start time
+    start = None
+    if self.enabled and (host or not self.cuda):
+      start = time.perf_counter()
+    elif self.enabled:
+      start = torch.cuda.Event(enable_timing=True)
+      start.record()
+    function = None
+    if self.profiling:
+      function = torch.autograd.profiler.record_function(name)
+      function.__enter__()
+    self.stack.append((name, start, function))
+
+  def stop(self):
+    if not self.stack:
+      return
+    name, start, function = self.stack.pop()
+    if function is not None:
+      function.__exit__(None, None, None)
+    if start is None:
+      return
+    elif isinstance(start, float):
+      end = time.perf_counter()
+    else:
+      end = torch.cuda.Event(enable_timing=True)
+      end.record()
+    self.records.append((name, start, end))
+
+  @contextlib.contextmanager
+  def phase(self, name, host=False):
+    self.start(name, host)
+    try:
+      yield
+    finally:
+      self.stop()
+
+  # Time a module's forward passes as a phase whenever they run inside
+  # another phase. Not for modules run under DataParallel, whose replicas
+  # would share the hooks across threads, or under torch.compile, which
+  # the hooks would break into pieces.
+  def time_module(self, module, name):
+    started = []
+    def pre_hook(module, input):
+      started.append(bool(self.stack))
+      if started[-1]:
+        self.start(name)
+    def hook(module, input, output):
+      if started.pop():
+        self.stop()
+    module.register_forward_pre_hook(pre_hook)
+    module.register_forward_hook(hook)
+
+  # Mark the end of an iteration
+  def step(self):
+    if not self.enabled:
+      return
+    self.itrs.append(self.records)
+    self.records = []
+
+  def summary(self):
+    times = collections.OrderedDict()
+    for records in self.itrs:
+      totals = collections.OrderedDict()
+      for name, start, end in records:
+        if isinstance(start, float):
+          elapsed = 1000. * (end - start)
+        else:
+          end.synchronize()
+          elapsed = start.elapsed_time(end)
+        totals[name] = totals.get(name, 0.) + elapsed
+      for name in totals:
+        times.setdefault(name, []).append(totals[name])
+    self.itrs = []
+    out = {}
+    for name in times:
+      out['time_%s_p50' % name] = float(np.percentile(times[name], 50))
+      out['time_%s_p90' % name] = float(np.percentile(times[name], 90))
+      out['time_%s_max' % name] = float(np.max(times[name]))
+    return out
+
+
+# Write a torch.profiler trace for a range of iterations, given as a string
+# like '100-105' (or a single iteration). step(itr) should be called at the
+# start of each iteration. If a PhaseTimer is given, its phases are labeled
+# in the trace.
+class IterationProfiler(object):
+  def __init__(self, itrs, fname, timer=None):
+    self.itrs = [int(itr) for itr in itrs.split('-')] if itrs else []
+    if len(self.itrs) == 1:
+      self.itrs *= 2
+    if len(self.itrs) not in [0, 2]:
+      raise ValueError('Expected an iteration range like 100-105, got %s' % itrs)
+    self.fname = fname
+    self.timer = timer
+    self.profiler = None
+
+  def step(self, itr):
+    if not self.itrs:
+      return
+    if self.profiler is None and self.itrs[0] <= itr <= self.itrs[1]:
+      activities = [torch.profiler.ProfilerActivity.CPU]
+      if torch.cuda.is_available():
+        activities += [torch.profiler.ProfilerActivity.CUDA]
+      self.profiler = torch.profiler.profile(activities=activities,
+                                             record_shapes=True)
+      self.profiler.__enter__()
+      if self.timer is not None:
+        self.timer.profiling = True
+    elif self.profiler is not None and itr > self.itrs[1]:
+      self.close()
+
+  def close(self):
+    if self.profiler is None:
+      return
+    if self.timer is not None:
+      self.timer.profiling = False
+    self.profiler.__exit__(None, None, None)
+    fname = '%s_trace_%d-%d.json' % (self.fname, self.itrs[0], self.itrs[1])
+    print('Writing profiler trace to %s...' % fname)
+    self.profiler.export_chrome_trace(fname)
+    self.profiler, self.itrs = None, []
+
+
 # Write some metadata to the logs directory
 def write_metadata(logs_root, experiment_name, config, state_dict):
   with open(('%s/%s/metalog.txt' % 
@@ -878,9 +1357,41 @@ def sample(G, z_, y_, config):
     return G_z, y_
 
 
+# Sample function for truncation curves, for get_inception_metrics with
+# curve=True. Each call draws unit noise and labels once and scales the noise
+# for each point as z_.sample_() would, so every point sees the same z and y.
+# In eval mode G's output for a sample doesn't depend on the rest of its
+# batch, so the points share fused G forwards of at most fused_batch_size.
+def sample_curve(points, G, z_, y_, variances, config, fused_batch_size=0):
+  fused_batch_size = fused_batch_size or y_.shape[0]
+  def forward(z, y):
+    if config['parallel']:
+      return nn.parallel.data_parallel(G, (z, G.shared(y)))
+    return G(z, G.shared(y))
+  with torch.no_grad():
+    z_.normal_()
+    y_.sample_()
+    zs = [z_.mean + float(variances[point]) * z_ for point in points]
+    if G.training:
+      return [forward(z, y_) for z in zs], y_
+    # Run the fused batch in chunks of at most fused_batch_size
+    G_z = torch.cat([forward(z, y) for z, y in
+                     zip(torch.cat(zs, 0).split(fused_batch_size),
+                         y_.repeat(len(points)).split(fused_batch_size))])
+    return list(G_z.split(y_.shape[0])), y_
+
+
+# Number of images to get each point of a truncation curve with, using
+# --trunc_early_images for every point but the last if it is set
+def trunc_curve_images(config, num_points):
+  return ([config['trunc_early_images'] or config['num_inception_images']]
+          * (num_points - 1) + [config['num_inception_images']])
+
+
 # Sample function for sample sheets
 def sample_sheet(G, classes_per_sheet, num_classes, samples_per_class, parallel,
-                 samples_root, experiment_name, folder_number, z_=None):
+                 samples_root, experiment_name, folder_number, z_=None,
+                 device='cuda'):
   # Prepare sample directory
   if not os.path.isdir('%s/%s' % (samples_root, experiment_name)):
     os.mkdir('%s/%s' % (samples_root, experiment_name))
@@ -889,12 +1400,12 @@ def sample_sheet(G, classes_per_sheet, num_classes, samples_per_class, parallel,
   # loop over total number of sheets
   for i in range(num_classes // classes_per_sheet):
     ims = []
-    y = torch.arange(i * classes_per_sheet, (i + 1) * classes_per_sheet, device='cuda')
+    y = torch.arange(i * classes_per_sheet, (i + 1) * classes_per_sheet, device=device)
     for j in range(samples_per_class):
       if (z_ is not None) and hasattr(z_, 'sample_') and classes_per_sheet <= z_.size(0):
         z_.sample_()
       else:
-        z_ = torch.randn(classes_per_sheet, G.dim_z, device='cuda')        
+        z_ = torch.randn(classes_per_sheet, G.dim_z, device=device)
       with torch.no_grad():
         if parallel:
           o = nn.parallel.data_parallel(G, (z_[:classes_per_sheet], G.shared(y)))
@@ -914,7 +1425,7 @@ def sample_sheet(G, classes_per_sheet, num_classes, samples_per_class, parallel,
 
 # Interp function; expects x0 and x1 to be of shape (shape0, 1, rest_of_shape..)
 def interp(x0, x1, num_midpoints):
-  lerp = torch.linspace(0, 1.0, num_midpoints + 2, device='cuda').to(x0.dtype)
+  lerp = torch.linspace(0, 1.0, num_midpoints + 2, device=x0.device).to(x0.dtype)
   return ((x0 * (1 - lerp.view(1, -1, 1))) + (x1 * lerp.view(1, -1, 1)))
 
 
@@ -932,12 +1443,12 @@ def interp_sheet(G, num_per_sheet, num_midpoints, num_classes, parallel,
                 torch.randn(num_per_sheet, 1, G.dim_z, device=device),
                 num_midpoints).view(-1, G.dim_z)
   if fix_y: # If fix y, only sample 1 z per row
-    ys = sample_1hot(num_per_sheet, num_classes)
+    ys = sample_1hot(num_per_sheet, num_classes, device)
     ys = G.shared(ys).view(num_per_sheet, 1, -1)
     ys = ys.repeat(1, num_midpoints + 2, 1).view(num_per_sheet * (num_midpoints + 2), -1)
   else:
-    ys = interp(G.shared(sample_1hot(num_per_sheet, num_classes)).view(num_per_sheet, 1, -1),
-                G.shared(sample_1hot(num_per_sheet, num_classes)).view(num_per_sheet, 1, -1),
+    ys = interp(G.shared(sample_1hot(num_per_sheet, num_classes, device)).view(num_per_sheet, 1, -1),
+                G.shared(sample_1hot(num_per_sheet, num_classes, device)).view(num_per_sheet, 1, -1),
                 num_midpoints).view(num_per_sheet * (num_midpoints + 2), -1)
   # Run the net--note that we've already passed y through G.shared.
   if G.fp16:
@@ -972,9 +1483,41 @@ def print_grad_norms(net):
 # and substitute underscores for dots.
 def get_SVs(net, prefix):
   d = net.state_dict()
-  return {('%s_%s' % (prefix, key)).replace('.', '_') :
-            float(d[key].item())
-            for key in d if 'sv' in key}
+  keys = [key for key in d if 'sv' in key]
+  if not keys:
+    return {}
+  # Gather the SVs into one tensor so they come back in a single transfer
+  svs = torch.stack([d[key].float().reshape(()) for key in keys]).tolist()
+  return {('%s_%s' % (prefix, key)).replace('.', '_') : sv
+          for key, sv in zip(keys, svs)}
+
+
+# Get the total norm of a net's grads, using its flat grads if it has them
+def grad_norm(net):
+  if getattr(net, 'flat', None) is not None:
+    return net.flat.grad_norm()
+  grads = [param.grad for param in net.parameters() if param.grad is not None]
+  if not grads:
+    return torch.zeros([])
+  return torch.norm(torch.stack([torch.norm(grad.float()) for grad in grads]))
+
+
+# Run a forward pass of net and return the names of any layers whose 4D
+# outputs are not channels_last, i.e. which have fallen back to NCHW.
+# Useful for checking that --channels_last holds end-to-end.
+def channels_last_report(net, *inputs):
+  fallbacks = []
+  def hook(name, module, input, output):
+    if (isinstance(output, torch.Tensor) and output.dim() == 4
+        and not output.is_contiguous(memory_format=torch.channels_last)):
+      fallbacks.append(name)
+  handles = [module.register_forward_hook(functools.partial(hook, name))
+             for name, module in net.named_modules() if name]
+  with torch.no_grad():
+    net(*inputs)
+  for handle in handles:
+    handle.remove()
+  return fallbacks
 
 
 # Name an experiment based on its config
@@ -1062,6 +1605,9 @@ def sample_1hot(batch_size, num_classes, device='cuda'):
 # x = x.to(device,dtype)
 # This is partially based on https://discuss.pytorch.org/t/subclassing-torch-tensor/23754/2
 class Distribution(torch.Tensor):
+  # Results of ops on a Distribution (e.g. G's output) are plain tensors
+  __torch_function__ = torch._C._disabled_torch_function_impl
+
   # Init the params of the distribution
   def init_distribution(self, dist_type, **kwargs):    
     self.dist_type = dist_type
@@ -1080,10 +1626,11 @@ class Distribution(torch.Tensor):
     
   # Silly hack: overwrite the to() method to wrap the new object
   # in a distribution as well
+  # (_make_subclass is used rather than assigning to .data so that the new
+  # object isn't a view of the old one, which trips up graph capture).
   def to(self, *args, **kwargs):
-    new_obj = Distribution(self)
+    new_obj = torch.Tensor._make_subclass(Distribution, super().to(*args, **kwargs))
     new_obj.init_distribution(self.dist_type, **self.dist_kwargs)
-    new_obj.data = super().to(*args, **kwargs)    
     return new_obj
 
 
@@ -1196,3 +1743,209 @@ class Adam16(Optimizer):
         p.data = state['fp32_p'].half()
 
     return loss
+
+
+# View the numel(like) elements of flat starting at offset as a tensor with
+# the same shape and memory layout (e.g. channels_last) as the dense tensor like
+def flat_view(flat, offset, like):
+  return flat[offset:offset + like.numel()].as_strided(like.size(), like.stride())
+
+
+# Flatten t in the memory order of the dense tensor like (which, for
+# channels_last tensors, isn't their logical order)
+def flatten_like(t, like):
+  if t.stride() != like.stride():
+    t = torch.empty_like(like, dtype=t.dtype).copy_(t)
+  return t.as_strided((t.numel(),), (1,))
+
+
+# If the dense tensors lie back to back (in order) in one storage, as after
+# FlatParams, return a 1D view covering all of them; else return None
+def flat_buffer(tensors):
+  first = tensors[0]
+  offset = first.storage_offset()
+  for t in tensors:
+    if (t.dtype != first.dtype
+        or t.untyped_storage().data_ptr() != first.untyped_storage().data_ptr()
+        or t.storage_offset() != offset
+        or not (t.is_contiguous() or t.is_contiguous(memory_format=torch.channels_last))):
+      return None
+    offset += t.numel()
+  return first.detach().as_strided((offset - first.storage_offset(),), (1,))
+
+
+# Flat storage for a model's params and grads. All params (of each dtype and
+# device, usually just one) are re-homed into one contiguous buffer, and their
+# grads into another, as views with the params' own shapes and memory layouts,
+# so that whole-model operations on them (zeroing grads, grad norms, EMA) are
+# single ops. The params themselves are the same objects with the same names,
+# and state_dict loading copies into them in place, so saving and loading are
+# unaffected. Set this as net.flat to have utils.zero_grad and utils.ema use
+# it; grads must be zeroed with zero_grad() here, as an optimizer's zero_grad
+# may set them to None.
+# A param's grad only becomes its view once it has had a grad of its own
+# (from then on, backward accumulates into the view in place), so params
+# that never get one keep a grad of None, and optimizers still skip them.
+class FlatParams(object):
+  def __init__(self, model):
+    groups = {}
+    for param in model.parameters():
+      groups.setdefault((param.dtype, param.device), []).append(param)
+    self.params, self.grads, self.views = [], [], []
+    for (dtype, device), params in groups.items():
+      if not all(p.is_contiguous() or p.is_contiguous(memory_format=torch.channels_last)
+                 for p in params):
+        raise ValueError('FlatParams needs contiguous or channels_last params')
+      numel = sum(p.numel() for p in params)
+      flat_param = torch.empty(numel, dtype=dtype, device=device)
+      flat_grad = torch.zeros(numel, dtype=dtype, device=device)
+      offset = 0
+      for p in params:
+        p.data = flat_view(flat_param, offset, p).copy_(p.data)
+        self.views.append((p, flat_view(flat_grad, offset, p)))
+        offset += p.numel()
+      self.params.append(flat_param)
+      self.grads.append(flat_grad)
+    self.attach_grads()
+
+  # Move any grad that isn't its param's view yet (e.g. from the param's
+  # first backward, or one that something else has replaced) into the view
+  def attach_grads(self):
+    for p, grad in self.views:
+      if p.grad is not None and p.grad is not grad:
+        grad.copy_(p.grad)
+        p.grad = grad
+
+  def zero_grad(self):
+    for p, grad in self.views:
+      if p.grad is not None and p.grad is not grad:
+        p.grad = grad
+    for grad in self.grads:
+      grad.zero_()
+
+  def grad_norm(self):
+    self.attach_grads()
+    return torch.norm(torch.stack([torch.norm(grad.float()) for grad in self.grads]))
+
+
+# Adam with fp32 master weights, as Adam16, but with each param group's fp32
+# state (master weights and both moments) held in flat buffers, so the update
+# is a few vector ops over the whole group instead of a loop over params.
+# The fp16 params are re-homed into a flat buffer of their own at the first
+# step (unless they already share one), so writing the new weights back is a
+# single copy. Per-param state entries are views into the flat buffers, so
+# state dicts are interchangeable with Adam16's.
+class FlatAdam16(Optimizer):
+  def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,weight_decay=0):
+    defaults = dict(lr=lr, betas=betas, eps=eps,
+            weight_decay=weight_decay)
+    params = list(params)
+    super(FlatAdam16, self).__init__(params, defaults)
+    # Flat (state, weights) buffers per param group, built at the first step
+    self.flat = None
+
+  def flatten(self):
+    self.flat = []
+    for group in self.param_groups:
+      params = group['params']
+      if any(p.dtype != params[0].dtype or p.device != params[0].device for p in params):
+        raise ValueError('FlatAdam16 needs all params in a group to share a dtype and device')
+      if not all(p.is_contiguous() or p.is_contiguous(memory_format=torch.channels_last)
+                 for p in params):
+        raise ValueError('FlatAdam16 needs contiguous or channels_last params')
+      numel = sum(p.numel() for p in params)
+      device = params[0].device
+      state_buffers = {key: torch.zeros(numel, device=device)
+                       for key in ['fp32_p', 'exp_avg', 'exp_avg_sq']}
+      # Reuse the params' buffer if they're already flat (e.g. FlatParams)
+      weights = flat_buffer(params)
+      rehome = weights is None
+      if rehome:
+        weights = torch.empty(numel, dtype=params[0].dtype, device=device)
+      offset = 0
+      for p in params:
+        state = self.state[p]
+        # State initialization; moments start as the buffers' zeros
+        if len(state) == 0:
+          state['step'] = 0
+          state['fp32_p'] = p.data.float()
+        for key, buffer in state_buffers.items():
+          view = flat_view(buffer, offset, p)
+          if key in state:
+            view.copy_(state[key])
+          state[key] = view
+        if rehome:
+          p.data = flat_view(weights, offset, p).copy_(p.data)
+        offset += p.numel()
+      self.flat.append((state_buffers, weights))
+
+  # The base class casts loaded state to the params' dtype, so take the state
+  # from the state dict directly to keep it in fp32, and rebuild the buffers
+  def load_state_dict(self, state_dict):
+    super(FlatAdam16, self).load_state_dict(state_dict)
+    params = [p for group in self.param_groups for p in group['params']]
+    ids = [i for group in state_dict['param_groups'] for i in group['params']]
+    for p, i in zip(params, ids):
+      if i in state_dict['state']:
+        self.state[p] = {key: (value.to(p.device, torch.float32, copy=True)
+                               if torch.is_tensor(value)
+                               and key != 'step' else value)
+                         for key, value in state_dict['state'][i].items()}
+    self.flat = None
+
+  def step(self, closure=None):
+    """Performs a single optimization step.
+    Arguments:
+      closure (callable, optional): A closure that reevaluates the model
+        and returns the loss.
+    """
+    loss = None
+    if closure is not None:
+      loss = closure()
+    if self.flat is None:
+      self.flatten()
+
+    for group, (state_buffers, weights) in zip(self.param_groups, self.flat):
+      # Params without grads are left as they are, as in Adam16, and each
+      # param keeps its own step count. The update runs over each run of
+      # adjacent params with grads and the same step count; normally that
+      # is a single run covering the whole group.
+      runs, offset = [], 0
+      for p in group['params']:
+        if p.grad is not None:
+          step = self.state[p]['step'] + 1
+          self.state[p]['step'] = step
+          if runs and runs[-1][1] == offset and runs[-1][2] == step:
+            runs[-1][1] += p.numel()
+          else:
+            runs.append([offset, offset + p.numel(), step])
+        offset += p.numel()
+      if not runs:
+        continue
+      # Gather the grads straight into an fp32 buffer
+      grad = torch.cat([flatten_like(p.grad, p) if p.grad is not None
+                        else p.new_zeros(p.numel()) for p in group['params']],
+                       out=torch.empty_like(state_buffers['fp32_p']))
+      beta1, beta2 = group['betas']
+
+      for start, end, step in runs:
+        fp32_p, exp_avg, exp_avg_sq = [state_buffers[key][start:end] for key in
+                                       ['fp32_p', 'exp_avg', 'exp_avg_sq']]
+        run_grad = grad[start:end]
+        if group['weight_decay'] != 0:
+          run_grad = run_grad.add(fp32_p, alpha=group['weight_decay'])
+
+        # Decay the first and second moment running average coefficient
+        exp_avg.mul_(beta1).add_(run_grad, alpha=1 - beta1)
+        exp_avg_sq.mul_(beta2).addcmul_(run_grad, run_grad, value=1 - beta2)
+
+        denom = exp_avg_sq.sqrt().add_(group['eps'])
+
+        bias_correction1 = 1 - beta1 ** step
+        bias_correction2 = 1 - beta2 ** step
+        step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
+
+        fp32_p.addcdiv_(exp_avg, denom, value=-step_size)
+      weights.copy_(state_buffers['fp32_p'])
+
+    return loss